@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Test of ScheduleExtractor against fixtures/shutdowns.html, a static copy of the page with a known schedule.
+Run with pytest, the tests are skipped when Selenium or Chrome is not available.
+"""
+
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("selenium")
+
+from selenium.common.exceptions import WebDriverException
+from test_schedule_extractor import ScheduleExtractor
+
+
+FIXTURE_URL = (Path(__file__).parent / "fixtures" / "shutdowns.html").absolute().as_uri()
+# Timestamp the fixture keys its only day by
+FIXTURE_DAY = "1766959200"
+
+
+@pytest.fixture
+def extractor(tmp_path):
+    extractor = ScheduleExtractor(output_dir=tmp_path, url=FIXTURE_URL)
+    try:
+        extractor._setup_driver()
+    except WebDriverException as e:
+        pytest.skip(f"Chrome is not available: {e}")
+    yield extractor
+    extractor.driver.quit()
+
+
+def _blocked_urls(driver):
+    """URLs of the requests Chrome refused because of Network.setBlockedURLs."""
+    urls = {}
+    blocked = set()
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        params = message.get("params", {})
+        if message.get("method") == "Network.requestWillBeSent":
+            urls[params["requestId"]] = params["request"]["url"]
+        elif message.get("method") == "Network.loadingFailed" and params.get("blockedReason") == "inspector":
+            blocked.add(urls.get(params["requestId"]))
+    return blocked
+
+
+def test_extracts_fixture_schedule(extractor):
+    fact = extractor.extract_schedule_json()
+
+    assert fact["update"] == "23.12.2025 15:30"
+    assert fact["today"] == int(FIXTURE_DAY)
+    assert list(fact["data"]) == [FIXTURE_DAY]
+    day = fact["data"][FIXTURE_DAY]
+    assert sorted(day) == [f"GPV{group}.{subgroup}" for group in range(1, 7) for subgroup in (1, 2)]
+    assert [day["GPV1.1"][str(hour)] for hour in range(8, 20)] == [
+        "yes", "no", "no", "no", "no", "first", "yes", "yes", "yes", "yes", "second", "yes"]
+    assert [day["GPV3.2"][str(hour)] for hour in range(18, 24)] == [
+        "yes", "maybe", "maybe", "maybe", "maybe", "yes"]
+    assert set(day["GPV6.2"].values()) == {"yes"}
+
+
+def test_blocks_subresources(extractor):
+    assert extractor.extract_schedule_json() is not None
+
+    assert "https://www.dtek-kem.com.ua/css/main.css" in _blocked_urls(extractor.driver)
@@ -4,11 +4,11 @@ Automated test for extracting DisconSchedule.fact JSON from DTEK website.
 This test uses Selenium WebDriver to control Chrome browser and extract JSON data.
 """
 
+import argparse
 import json
 import hashlib
 import os
 import re
-import time
 from datetime import datetime
 from pathlib import Path
 from zoneinfo import ZoneInfo
@@ -19,9 +19,8 @@ KYIV_TZ = ZoneInfo("Europe/Kyiv")
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 
 try:
     from webdriver_manager.chrome import ChromeDriverManager
@@ -30,20 +29,45 @@ except ImportError:
     WEBDRIVER_MANAGER_AVAILABLE = False
 
 
+DEFAULT_URL = "https://www.dtek-kem.com.ua/ua/shutdowns"
+
+# URLs Chrome is told not to load: images, styles, fonts, media and trackers are not needed to get
+# the schedule, which is set by an inline script. Patterns as for Network.setBlockedURLs
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.css",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp4", "*.webm", "*.mp3",
+    "*googletagmanager.com*", "*google-analytics.com*", "*doubleclick.net*",
+    "*facebook.net*", "*facebook.com/tr*",
+]
+
+# Serializes the schedule in the page, without going through the DOM
+READ_FACT_SCRIPT = """
+return (typeof DisconSchedule !== 'undefined' && DisconSchedule && DisconSchedule.fact)
+    ? JSON.stringify(DisconSchedule.fact) : null;
+"""
+
+
 class ScheduleExtractor:
     """Extracts power outage schedule JSON from DTEK website using Chrome."""
     
-    def __init__(self, headless=True, output_dir="."):
+    def __init__(self, headless=True, output_dir=".", url=DEFAULT_URL, block_resources=True, timeout=15):
         """
         Initialize the schedule extractor.
         
         Args:
             headless: Run Chrome in headless mode (no GUI)
             output_dir: Directory to save extracted JSON files
+            url: Page with the schedule, e.g. file:// URL of a saved copy for testing
+            block_resources: Don't load images, styles, fonts, media and trackers
+            timeout: Seconds to wait for the schedule to appear
         """
-        self.url = "https://www.dtek-kem.com.ua/ua/shutdowns"
+        self.url = url
         self.output_dir = Path(output_dir)
         self.headless = headless
+        self.block_resources = block_resources
+        self.timeout = timeout
         self.driver = None
         
     def _setup_driver(self):
@@ -63,6 +87,10 @@ class ScheduleExtractor:
         chrome_options.add_argument("--window-size=1920,1080")
         chrome_options.add_argument("--user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36")
         chrome_options.add_argument("--disable-software-rasterizer")
+        # The schedule is in an inline script, there is no need to wait for subresources
+        chrome_options.page_load_strategy = "eager"
+        # Network events, to pick the schedule from XHR responses if the page loads it that way
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
         
         # Check if running in Docker/Alpine with Chromium
         chromium_path = "/usr/bin/chromium-browser"
@@ -85,6 +113,11 @@ class ScheduleExtractor:
             self.driver = webdriver.Chrome(options=chrome_options)
         
         self.driver.set_page_load_timeout(30)
+
+        self.driver.execute_cdp_cmd("Network.enable", {})
+        if self.block_resources:
+            self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+            print(f"[{self._timestamp()}] Blocking {len(BLOCKED_URL_PATTERNS)} URL patterns")
         
         print(f"[{self._timestamp()}] Chrome WebDriver initialized successfully")
         
@@ -96,6 +129,45 @@ class ScheduleExtractor:
         """Calculate MD5 hash of content."""
         return hashlib.md5(content.encode('utf-8')).hexdigest()
     
+    def _read_fact_from_page(self):
+        """
+        Wait until the page script has set DisconSchedule.fact and read it from the JS context.
+
+        Returns:
+            str: JSON of the schedule or None if it did not appear in time
+        """
+        try:
+            return WebDriverWait(self.driver, self.timeout).until(
+                lambda driver: driver.execute_script(READ_FACT_SCRIPT))
+        except TimeoutException:
+            return None
+
+    def _read_fact_from_responses(self):
+        """
+        Find the schedule among the JSON responses the page has received.
+
+        Returns:
+            str: JSON of the schedule or None if no response carried it
+        """
+        for entry in self.driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            if message.get("method") != "Network.responseReceived":
+                continue
+            params = message["params"]
+            if params.get("type") not in ("XHR", "Fetch") or "json" not in params["response"].get("mimeType", ""):
+                continue
+            try:
+                body = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": params["requestId"]})
+                response = json.loads(body["body"])
+            except (WebDriverException, ValueError):
+                continue
+            # The schedule API wraps it like the page does: {"fact": {"data": ...}}
+            fact = response.get("fact", response) if isinstance(response, dict) else None
+            if isinstance(fact, dict) and "data" in fact:
+                print(f"[{self._timestamp()}] Schedule found in response from {params['response']['url']}")
+                return json.dumps(fact, ensure_ascii=False)
+        return None
+
     def extract_schedule_json(self):
         """
         Navigate to the website and extract DisconSchedule.fact JSON.
@@ -107,41 +179,14 @@ class ScheduleExtractor:
             print(f"[{self._timestamp()}] Navigating to {self.url}")
             self.driver.get(self.url)
             
-            # Wait for page to load
-            print(f"[{self._timestamp()}] Waiting for page to load...")
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
+            print(f"[{self._timestamp()}] Reading DisconSchedule.fact...")
+            json_str = self._read_fact_from_page() or self._read_fact_from_responses()
             
-            # Give additional time for JavaScript to execute
-            time.sleep(5)
-            
-            print(f"[{self._timestamp()}] Extracting page source...")
-            page_source = self.driver.page_source
-
-            # Dump page source to file for debugging
-            debug_file = self.output_dir / f"page_source_{datetime.now(KYIV_TZ).strftime('%Y%m%d_%H%M%S')}.html"
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                f.write(page_source)
-            print(f"[{self._timestamp()}] Page source saved to {debug_file.name}")
-            
-            # Extract DisconSchedule.fact using regex
-            print(f"[{self._timestamp()}] Searching for DisconSchedule.fact...")
-            pattern = r'DisconSchedule\.fact\s*=\s*(\{.*?\});?(\</script\>)'
-            match = re.search(pattern, page_source, re.DOTALL)
-            
-            if not match:
-                print(f"[{self._timestamp()}] ERROR: DisconSchedule.fact not found in page source")
+            if not json_str:
+                print(f"[{self._timestamp()}] ERROR: DisconSchedule.fact not found in the page")
                 return None
             
-            json_str = match.group(1)
             print(f"[{self._timestamp()}] DisconSchedule.fact extracted successfully")
-            
-            # Dump raw JSON string to file for debugging
-            json_debug_file = self.output_dir / f"schedule_json_{datetime.now(KYIV_TZ).strftime('%Y%m%d_%H%M%S')}.json"
-            with open(json_debug_file, 'w', encoding='utf-8') as f:
-                f.write(json_str)
-            print(f"[{self._timestamp()}] Raw JSON saved to {json_debug_file.name}")
 
             # Parse JSON to validate
             try:
@@ -220,18 +265,31 @@ class ScheduleExtractor:
                 print(f"[{self._timestamp()}] Chrome WebDriver closed")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Extract DisconSchedule.fact JSON with Chrome.')
+    parser.add_argument('--url', type=str, default=DEFAULT_URL,
+                        help='Page with the schedule, e.g. file:///app/fixtures/shutdowns.html')
+    parser.add_argument('--output_dir', type=str,
+                        help='Directory to save the JSON to, /app/output in Docker and .. otherwise')
+    parser.add_argument('--headful', action='store_true', help='Show the browser window')
+    parser.add_argument('--load_all', action='store_true',
+                        help='Load images, styles, fonts and trackers too')
+    return parser.parse_args()
+
+
 def main():
     """Entry point for the test."""
+    args = parse_args()
     print("=" * 70)
     print("Schedule Extractor Test - Starting")
     print("=" * 70)
     
     # Determine output directory (use /app/output in Docker, .. otherwise)
-    output_dir = "/app/output" if os.path.exists("/app/output") else ".."
+    output_dir = args.output_dir or ("/app/output" if os.path.exists("/app/output") else "..")
     
     # Initialize extractor
-    # Set headless=False to see the browser in action
-    extractor = ScheduleExtractor(headless=True, output_dir=output_dir)
+    extractor = ScheduleExtractor(headless=not args.headful, output_dir=output_dir, url=args.url,
+                                  block_resources=not args.load_all)
     
     # Run extraction
     success = extractor.run()
@@ -66,8 +66,9 @@ if [ "$MODE" = "html" ]; then
   OUTPUT_FILE="in/${SAFE_MD5}.json"
   
   if [ -e "$OUTPUT_FILE" ]; then
-    log "File $OUTPUT_FILE already exists. Do nothing."
-    exit 0
+    log "File $OUTPUT_FILE already exists. Dispatching settled changes only."
+    python src/main.py --input_dir in --out_dir out --group_log group_logs --mode flush
+    exit $?
   fi
   
   echo "$FACT_JSON" > "$OUTPUT_FILE"
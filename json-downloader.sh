@@ -43,14 +43,35 @@ SAFE_MD5=$(echo "$MD5_SUM" | tr -cd 'a-f0-9')
 # Save JSON file
 OUTPUT_FILE="${INPUT_DIRECTORY}/${SAFE_MD5}.json"
 
-if [ -e "$OUTPUT_FILE" ]; then
-    log "File $OUTPUT_FILE already exists. No changes detected."
-    exit 0
+# When several notifier instances share the input directory, the file may have been
+# saved by another shard, so each shard tracks the inputs it has processed itself
+SHARD_COUNT=${SHARD_COUNT:-1}
+SHARD_INDEX=${SHARD_INDEX:-0}
+PROCESSED_MARKER=""
+if [ "$SHARD_COUNT" -gt 1 ]; then
+    mkdir -p "${GROUP_LOGS_DIRECTORY}/shard-${SHARD_INDEX}"
+    PROCESSED_MARKER="${GROUP_LOGS_DIRECTORY}/shard-${SHARD_INDEX}/input-${SAFE_MD5}"
 fi
 
-echo "$JSON_CONTENT" > "$OUTPUT_FILE"
-log "Schedule data saved as $OUTPUT_FILE"
+if [ -e "$OUTPUT_FILE" ]; then
+    if [ -z "$PROCESSED_MARKER" ] || [ -e "$PROCESSED_MARKER" ]; then
+        log "File $OUTPUT_FILE already exists. No changes detected."
+        # Changes held back while the supplier was still updating may have settled by now
+        python src/main.py --input_dir "${INPUT_DIRECTORY}" --out_dir "${OUTPUT_DIRECTORY}" --group_log "${GROUP_LOGS_DIRECTORY}" --mode flush \
+            --shard_index "$SHARD_INDEX" --shard_count "$SHARD_COUNT"
+        exit $?
+    fi
+    log "File $OUTPUT_FILE was saved by another shard"
+else
+    echo "$JSON_CONTENT" > "$OUTPUT_FILE"
+    log "Schedule data saved as $OUTPUT_FILE"
+fi
 
 # Process the JSON file if needed
 log "Starting processing"
-python src/main.py --input_dir "${INPUT_DIRECTORY}" --out_dir "${OUTPUT_DIRECTORY}" --src "$OUTPUT_FILE" --group_log "${GROUP_LOGS_DIRECTORY}" --mode json
\ No newline at end of file
+python src/main.py --input_dir "${INPUT_DIRECTORY}" --out_dir "${OUTPUT_DIRECTORY}" --src "$OUTPUT_FILE" --group_log "${GROUP_LOGS_DIRECTORY}" --mode json \
+    --shard_index "$SHARD_INDEX" --shard_count "$SHARD_COUNT" || exit $?
+
+if [ -n "$PROCESSED_MARKER" ]; then
+    touch "$PROCESSED_MARKER"
+fi
\ No newline at end of file
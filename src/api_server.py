@@ -0,0 +1,182 @@
+"""Read-only HTTP API over the latest converted schedules."""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from image_generator import encode_schedule_table_png, render_schedule_table
+from json_converter import load_converted_schedule
+
+logger = logging.getLogger(__name__)
+
+# Rendered images kept in memory, per (schedule hash, groups)
+IMAGE_CACHE_SIZE = 256
+# Most groups a request may ask for, every distinct list is rendered and cached on its own
+MAX_REQUEST_GROUPS = int(os.getenv('API_MAX_REQUEST_GROUPS') or 4)
+
+
+class ScheduleCache:
+    """
+    Latest converted schedule per date, loaded from out_dir.
+
+    Files are read only when meta_info.json changes, requests are served from memory.
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.meta_mtime = None
+        # date -> (content hash, schedule)
+        self.schedules = {}
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        meta_file_path = os.path.join(self.out_dir, 'meta_info.json')
+        try:
+            meta_mtime = os.path.getmtime(meta_file_path)
+        except FileNotFoundError:
+            return
+        if meta_mtime == self.meta_mtime:
+            return
+        with open(meta_file_path, 'r') as f:
+            meta_info = json.load(f)
+        schedules = {}
+        for schedule_date, file_name in meta_info.items():
+            content_hash = os.path.splitext(file_name)[0]
+            cached = self.schedules.get(schedule_date)
+            if cached and cached[0] == content_hash:
+                schedules[schedule_date] = cached
+                continue
+            try:
+                schedule = load_converted_schedule(os.path.join(self.out_dir, file_name))
+            except FileNotFoundError:
+                logger.warning(f"Schedule file is missing: {file_name}")
+                continue
+            schedules[schedule_date] = (content_hash, schedule)
+        with self.lock:
+            self.schedules = schedules
+            self.meta_mtime = meta_mtime
+        logger.info(f"Loaded schedules: {sorted(schedules)}")
+
+    def get(self, schedule_date):
+        with self.lock:
+            return self.schedules.get(schedule_date)
+
+    def dates(self):
+        with self.lock:
+            return {schedule_date: cached[0] for schedule_date, cached in self.schedules.items()}
+
+    def image(self, schedule_date, groups):
+        cached = self.get(schedule_date)
+        if cached is None:
+            return None
+        key = (cached[0], tuple(groups) if groups else None)
+        with self.lock:
+            png_bytes = self.images.get(key)
+        if png_bytes is None:
+            png_bytes = encode_schedule_table_png(render_schedule_table(cached[1], groups))
+            with self.lock:
+                if len(self.images) >= IMAGE_CACHE_SIZE:
+                    self.images.pop(next(iter(self.images)))
+                self.images[key] = png_bytes
+        return png_bytes
+
+
+def _etag(content_hash, groups, kind):
+    """Strong ETag derived from the content-addressed schedule file name."""
+    groups_hash = hashlib.md5(','.join(groups).encode()).hexdigest()[:8] if groups else 'all'
+    return f'"{content_hash}-{groups_hash}-{kind}"'
+
+
+def make_handler(cache):
+    class ScheduleRequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _send(self, status, body=b'', content_type='application/json', etag=None):
+            self.send_response(status)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            if status != 304:
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def _not_modified(self, etag):
+            if_none_match = self.headers.get('If-None-Match', '')
+            return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            parts = [part for part in url.path.split('/') if part]
+            groups = [group for value in parse_qs(url.query).get('groups', []) for group in value.split(',') if group]
+            # Repeated groups would only be separate cache entries
+            groups = list(dict.fromkeys(groups))
+
+            if parts == ['schedule']:
+                body = json.dumps(cache.dates()).encode()
+                return self._send(200, body)
+            if len(parts) not in (2, 3) or parts[0] != 'schedule' or (len(parts) == 3 and parts[2] != 'image'):
+                return self._send(404, b'{"error": "not found"}')
+
+            cached = cache.get(parts[1])
+            if cached is None:
+                return self._send(404, b'{"error": "no schedule for the date"}')
+            unknown_groups = [group for group in groups if group not in cached[1].groups]
+            if unknown_groups:
+                return self._send(400, json.dumps({"error": f"unknown groups: {unknown_groups}"}).encode())
+            if len(groups) > MAX_REQUEST_GROUPS:
+                return self._send(400, json.dumps({"error": f"at most {MAX_REQUEST_GROUPS} groups"}).encode())
+            kind = 'image' if len(parts) == 3 else 'json'
+            etag = _etag(cached[0], groups, kind)
+            if self._not_modified(etag):
+                return self._send(304, etag=etag)
+
+            if kind == 'image':
+                png_bytes = cache.image(parts[1], groups)
+                if png_bytes is None:
+                    # The schedule was dropped by a reload since it was looked up
+                    return self._send(404, b'{"error": "no schedule for the date"}')
+                return self._send(200, png_bytes, 'image/png', etag)
+            body = json.dumps(cached[1].to_dict(groups), ensure_ascii=False).encode()
+            return self._send(200, body, 'application/json; charset=utf-8', etag)
+
+    return ScheduleRequestHandler
+
+
+def _watch(cache, interval):
+    while True:
+        try:
+            cache.refresh()
+        except Exception as e:
+            logger.error(f"Failed to reload schedules: {e}")
+        time.sleep(interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve the latest schedules over HTTP.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Directory with the converted schedules')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--reload_interval', type=float, default=5,
+                        help='Seconds between checks of meta_info.json for new schedules')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    cache = ScheduleCache(args.out_dir)
+    cache.refresh()
+    threading.Thread(target=_watch, args=(cache, args.reload_interval), daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(cache))
+    logger.info(f"Serving schedules on {args.host}:{args.port}")
+    server.serve_forever()
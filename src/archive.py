@@ -0,0 +1,334 @@
+"""Append-only binary archive of every schedule version."""
+import argparse
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+from config import config
+from schedule_model import SLOTS_PER_DAY, Schedule
+
+logger = logging.getLogger(__name__)
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+ARCHIVE_FILE_NAME = 'schedule-archive.bin'
+REGION = os.getenv('SCHEDULE_REGION') or 'dtek'
+
+MASK_BYTES = 6
+GROUP_NAME_BYTES = 8
+
+# File header: magic, format version, number of groups, record size
+_HEADER = struct.Struct('<8sHHI')
+_MAGIC = b'BSNARCH1'
+# Version 2 follows the header with the group names, in the row order of the masks, and tells
+# in every record which groups the version had
+_FORMAT_VERSION = 2
+# Version 1 archives had no group names and always these groups
+_V1_GROUPS = [f"{group}.{subgroup}" for group in range(1, 7) for subgroup in (1, 2)]
+# Record: region, date (proleptic ordinal), version (unix seconds), bit set of the groups the
+# version had (version 2 only), then one 48-bit mask per group
+_RECORD_KEYS = {1: struct.Struct('<8sIq'), 2: struct.Struct('<8sIqQ')}
+MAX_GROUPS = 64
+
+
+def _record_size(group_count, format_version=_FORMAT_VERSION):
+    return _RECORD_KEYS[format_version].size + MASK_BYTES * group_count
+
+
+def slot_masks(schedule):
+    """
+    Half-hour blackout masks of a schedule: bit N of a group mask is set when
+    the group has no power during slot N (00:00-00:30 is slot 0).
+
+    Returns:
+        dict: group -> int, for every group of the schedule
+    """
+    return {group: schedule.mask(group) for group in schedule.groups}
+
+
+def schedule_version(schedule):
+    """Version timestamp of a schedule: its last_updated time, or now when it is missing."""
+    last_updated = schedule.last_updated
+    if last_updated:
+        try:
+            return int(datetime.strptime(last_updated, "%d.%m.%Y %H:%M").replace(tzinfo=KYIV_TZ).timestamp())
+        except ValueError:
+            logger.warning(f"Could not parse last_updated: {last_updated}")
+    return int(datetime.now(KYIV_TZ).timestamp())
+
+
+class ScheduleArchive:
+    """
+    Fixed-width records of (region, date, version, group masks), appended in the order the
+    versions were seen. The file is memory-mapped for queries and indexed by date on open.
+
+    The groups are stored in the file. A version with a group the archive does not know yet
+    rewrites the file with a mask row for it, older versions are marked as not having it.
+
+    All shards write the same file, so appends and rewrites hold an exclusive lock on a
+    companion lock file and first catch up with what other processes wrote.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._map = None
+        with self._locked(refresh=False):
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                with open(path, 'wb') as f:
+                    f.write(self._header([]))
+            self._open()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._records
+
+    @contextmanager
+    def _locked(self, refresh=True):
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if refresh:
+                    self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # Another process may have appended to the file, or replaced it with a rewrite
+        if os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            self.close()
+            self._open()
+        else:
+            self._load()
+
+    @staticmethod
+    def _header(groups):
+        names = b''.join(group.encode().ljust(GROUP_NAME_BYTES, b'\0') for group in groups)
+        return _HEADER.pack(_MAGIC, _FORMAT_VERSION, len(groups), _record_size(len(groups))) + names
+
+    def _open(self):
+        self._file = open(self.path, 'rb')
+        self._records = 0
+        self._date_index = {}
+        magic, format_version, group_count, record_size = _HEADER.unpack(self._file.read(_HEADER.size))
+        if magic != _MAGIC or format_version not in _RECORD_KEYS \
+                or record_size != _record_size(group_count, format_version) \
+                or (format_version == 1 and group_count != len(_V1_GROUPS)):
+            raise ValueError(f"Unsupported schedule archive: {self.path}")
+        if format_version == 1:
+            self.groups = list(_V1_GROUPS)
+        else:
+            names = self._file.read(GROUP_NAME_BYTES * group_count)
+            self.groups = [names[i:i + GROUP_NAME_BYTES].rstrip(b'\0').decode()
+                           for i in range(0, len(names), GROUP_NAME_BYTES)]
+        self._format_version = format_version
+        self._record_key = _RECORD_KEYS[format_version]
+        self._data_offset = self._file.tell()
+        self._record_size = record_size
+        self._load()
+
+    def _load(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        records = (len(self._map) - self._data_offset) // self._record_size
+        # Only the new tail has to be indexed after an append
+        for record_number in range(self._records, records):
+            date_ordinal = self._record_key.unpack_from(self._map, self._offset(record_number))[1]
+            self._date_index.setdefault(date_ordinal, []).append(record_number)
+        self._records = records
+
+    def _offset(self, record_number):
+        return self._data_offset + record_number * self._record_size
+
+    def _mask(self, record_number, group_index):
+        offset = self._offset(record_number) + self._record_key.size + group_index * MASK_BYTES
+        return int.from_bytes(self._map[offset:offset + MASK_BYTES], 'little')
+
+    def _present(self, record_number):
+        """Bit set of the groups the version had, every group of a version 1 archive."""
+        if self._format_version == 1:
+            return (1 << len(self.groups)) - 1
+        return self._record_key.unpack_from(self._map, self._offset(record_number))[3]
+
+    def _record(self, record_number):
+        region, date_ordinal, version = self._record_key.unpack_from(self._map, self._offset(record_number))[:3]
+        present = self._present(record_number)
+        masks = {group: self._mask(record_number, group_index) for group_index, group in enumerate(self.groups)
+                 if present >> group_index & 1}
+        return region.rstrip(b'\0').decode(), date.fromordinal(date_ordinal), version, masks
+
+    def _pack(self, region, date_ordinal, version, masks):
+        present = sum(1 << group_index for group_index, group in enumerate(self.groups) if group in masks)
+        return _RECORD_KEYS[_FORMAT_VERSION].pack(region.encode(), date_ordinal, version, present) + b''.join(
+            masks.get(group, 0).to_bytes(MASK_BYTES, 'little') for group in self.groups)
+
+    def _add_groups(self, new_groups):
+        """Rewrite the archive with mask rows for new groups, appended after the known ones."""
+        for group in new_groups:
+            if len(group.encode()) > GROUP_NAME_BYTES:
+                raise ValueError(f"Group name is limited to {GROUP_NAME_BYTES} bytes: {group}")
+        if len(self.groups) + len(new_groups) > MAX_GROUPS:
+            raise ValueError(f"The archive is limited to {MAX_GROUPS} groups")
+        records = [self._record(record_number) for record_number in range(self._records)]
+        self.groups = self.groups + new_groups
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._header(self.groups))
+                for region, record_date, version, masks in records:
+                    f.write(self._pack(region, record_date.toordinal(), version, masks))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.close()
+        self._open()
+        logger.info(f"Schedule archive rewritten, new groups: {new_groups}")
+
+    def _record_numbers(self, schedule_date, region):
+        encoded_region = region.encode()
+        return [record_number for record_number in self._date_index.get(schedule_date.toordinal(), [])
+                if self._map[self._offset(record_number):self._offset(record_number) + 8].rstrip(b'\0') == encoded_region]
+
+    def versions(self, schedule_date, region=REGION):
+        """
+        All archived versions of the date, oldest first.
+
+        Returns:
+            list: (region, date, version timestamp, dict of group -> mask) tuples, with the
+                groups the version had
+        """
+        return [self._record(record_number) for record_number in self._record_numbers(schedule_date, region)]
+
+    def append(self, schedule_date, version, masks, region=REGION):
+        """
+        Append a version of the date unless it has the same masks as the latest archived one.
+
+        Returns:
+            bool: True if a record was written
+        """
+        if len(region.encode()) > 8:
+            raise ValueError(f"Region name is limited to 8 bytes: {region}")
+        with self._locked():
+            new_groups = sorted(set(masks) - set(self.groups))
+            if new_groups or self._format_version != _FORMAT_VERSION:
+                self._add_groups(new_groups)
+            latest = self._record_numbers(schedule_date, region)
+            if latest and self._record(latest[-1])[3] == masks:
+                return False
+            with open(self.path, 'ab') as f:
+                f.write(self._pack(region, schedule_date.toordinal(), version, masks))
+            self._load()
+        return True
+
+    def append_schedule(self, schedule, region=REGION):
+        return self.append(schedule.date, schedule_version(schedule), slot_masks(schedule), region)
+
+    def group_history(self, group, start_date, end_date, region=REGION):
+        """
+        Versions of one group's mask for the dates in [start_date, end_date].
+
+        Returns:
+            list: (date, version timestamp, mask) tuples ordered by date, then by version, the
+                mask is None for versions without the group
+        """
+        if group not in self.groups:
+            return []
+        group_index = self.groups.index(group)
+        history = []
+        for date_ordinal in sorted(self._date_index):
+            if not start_date.toordinal() <= date_ordinal <= end_date.toordinal():
+                continue
+            for record_number in self._record_numbers(date.fromordinal(date_ordinal), region):
+                version = self._record_key.unpack_from(self._map, self._offset(record_number))[2]
+                mask = self._mask(record_number, group_index) if self._present(record_number) >> group_index & 1 else None
+                history.append((date.fromordinal(date_ordinal), version, mask))
+        return history
+
+    def count_changes(self, group, start_date, end_date, region=REGION):
+        """
+        Number of times a published schedule of the group was changed for the dates in range.
+        A group appearing in or disappearing from a version is not a change of its schedule.
+        """
+        changes = 0
+        previous = None
+        for schedule_date, _, mask in self.group_history(group, start_date, end_date, region):
+            if previous is not None and previous[0] == schedule_date and None not in (previous[1], mask) \
+                    and previous[1] != mask:
+                changes += 1
+            previous = (schedule_date, mask)
+        return changes
+
+
+def archive_path():
+    return os.path.join(config.out_dir, ARCHIVE_FILE_NAME)
+
+
+def archive_schedules(schedules):
+    """Append converted schedules to the archive in out_dir."""
+    with ScheduleArchive(archive_path()) as archive:
+        for schedule in schedules:
+            if archive.append_schedule(schedule):
+                logger.info(f"Archived new version of {schedule.date_time}")
+
+
+def format_mask(mask):
+    if mask is None:
+        return '-' * SLOTS_PER_DAY
+    return ''.join('#' if mask >> slot & 1 else '.' for slot in range(SLOTS_PER_DAY))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Query the schedule archive.')
+    parser.add_argument('--archive', type=str, required=True, help='Path to the archive file')
+    parser.add_argument('--backfill', type=str, help='Directory with converted schedule JSON files to archive first')
+    parser.add_argument('--group', type=str, help='Group to report, e.g. 4.2')
+    parser.add_argument('--from', dest='start_date', type=str, help='First date, DD.MM.YYYY')
+    parser.add_argument('--to', dest='end_date', type=str, help='Last date, DD.MM.YYYY')
+    parser.add_argument('--region', type=str, default=REGION)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    with ScheduleArchive(args.archive) as archive:
+        if args.backfill:
+            schedules = []
+            for file_path in glob.glob(os.path.join(args.backfill, '*.json')):
+                with open(file_path, 'r') as f:
+                    schedule = json.load(f)
+                if isinstance(schedule, dict) and "date_time" in schedule and "blackouts" in schedule:
+                    schedules.append(Schedule.from_json(schedule))
+            schedules.sort(key=schedule_version)
+            appended = sum(archive.append_schedule(schedule, args.region) for schedule in schedules)
+            logger.info(f"Backfilled {appended} versions from {len(schedules)} files")
+        if args.group:
+            start_date = datetime.strptime(args.start_date, "%d.%m.%Y").date() if args.start_date else date.min
+            end_date = datetime.strptime(args.end_date, "%d.%m.%Y").date() if args.end_date else date.max
+            for schedule_date, version, mask in archive.group_history(args.group, start_date, end_date, args.region):
+                version_str = datetime.fromtimestamp(version, tz=KYIV_TZ).strftime("%d.%m.%Y %H:%M")
+                print(f"{schedule_date.strftime('%d.%m.%Y')}  {version_str}  {format_mask(mask)}")
+            print(f"Changes: {archive.count_changes(args.group, start_date, end_date, args.region)}")
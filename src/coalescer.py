@@ -0,0 +1,169 @@
+"""Debouncing of schedule changes before they are dispatched to chats."""
+import json
+import logging
+import os
+import time
+from config import config
+from json_converter import load_converted_schedule
+from schedule_handler import UpdateBatch, group_digests, handle_schedule_change, plan_schedule_change
+from sharding import shard_file_name, shard_name
+from subscribers import open_subscriber_store
+
+logger = logging.getLogger(__name__)
+
+PENDING_FILE_NAME = 'pending-dispatch.json'
+
+# A changed group is dispatched once it has not changed for this long, 0 dispatches immediately
+QUIET_SECONDS = int(os.getenv('COALESCE_QUIET_SECONDS') or 0)
+# ...but no later than this after the first undispatched change of the date
+MAX_DELAY_SECONDS = int(os.getenv('COALESCE_MAX_DELAY_SECONDS') or 1800)
+
+
+def _pending_path():
+    return os.path.join(config.out_dir, shard_file_name(PENDING_FILE_NAME))
+
+
+def _load_pending():
+    pending_path = _pending_path()
+    if not os.path.exists(pending_path):
+        return {}
+    with open(pending_path, 'r') as f:
+        return json.load(f)
+
+
+def _save_pending(pending):
+    pending_path = _pending_path()
+    tmp_path = f"{pending_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(pending, f, indent=2)
+    os.replace(tmp_path, pending_path)
+
+
+def register_changes(schedules, src):
+    """
+    Record the new versions of the schedules.
+
+    Only groups that differ from what was last dispatched are kept as pending. A group whose
+    schedule changes again restarts its quiet window, intermediate versions are never sent.
+
+    Args:
+        schedules: List of (schedule, file name in out_dir) tuples
+        src: Source file the schedules were converted from
+    """
+    pending = _load_pending()
+    with open_subscriber_store() as store:
+        _register(pending, schedules, src, store, time.time())
+    _save_pending(pending)
+
+
+def _register(pending, schedules, src, store, now):
+    for schedule, file_name in schedules:
+        schedule_date = schedule.date_time
+        digests = group_digests(schedule)
+        undispatched = store.changed_groups(shard_name(), schedule_date, digests)
+        entry = pending.get(schedule_date) or {"first_seen": now, "groups": {}}
+        groups = {}
+        for group in undispatched:
+            previous = entry["groups"].get(group)
+            groups[group] = previous if previous and previous[0] == digests[group] else [digests[group], now]
+        if not groups:
+            entry["first_seen"] = now
+        entry.update({"file": file_name, "src": src, "groups": groups})
+        pending[schedule_date] = entry
+        logger.info(f"Pending changes for {schedule_date}: {sorted(groups)}")
+
+
+def _settled(pending, now):
+    """
+    Pending dates with changes to dispatch now.
+
+    Yields:
+        tuple: (schedule date, pending entry, settled groups, groups still changing)
+    """
+    for schedule_date, entry in list(pending.items()):
+        overdue = now - entry["first_seen"] >= MAX_DELAY_SECONDS
+        settled = {group for group, (_, last_changed) in entry["groups"].items()
+                   if overdue or now - last_changed >= QUIET_SECONDS}
+        if entry["groups"] and not settled:
+            logger.info(f"Holding changes for {schedule_date} until they settle: {sorted(entry['groups'])}")
+            continue
+        yield schedule_date, entry, settled, set(entry["groups"]) - settled
+
+
+def _pending_schedule(entry, schedules_by_file):
+    schedule = schedules_by_file.get(entry["file"])
+    if schedule is None:
+        try:
+            schedule = load_converted_schedule(os.path.join(config.out_dir, entry["file"]))
+        except FileNotFoundError:
+            logger.warning(f"Schedule file is missing, dropping pending changes: {entry['file']}")
+    return schedule
+
+
+def dispatch_settled(group_log, schedules_by_file=None, pipeline=None):
+    """
+    Dispatch the pending changes that have settled.
+
+    Args:
+        group_log: Directory for tracking group schedule changes
+        schedules_by_file: Schedules converted in this run, by file name, to avoid reloading them
+        pipeline: DispatchPipeline to render and send the updates with
+    """
+    schedules_by_file = schedules_by_file or {}
+    pending = _load_pending()
+    now = time.time()
+    # Chats affected on several dates get them in one album
+    batch = UpdateBatch(pipeline)
+    for schedule_date, entry, settled, unsettled in _settled(pending, now):
+        schedule = _pending_schedule(entry, schedules_by_file)
+        if schedule is None:
+            del pending[schedule_date]
+            continue
+
+        logger.info(f"Dispatching settled changes for {schedule_date}: {sorted(settled)}")
+        # Chats that also have a group still changing wait for it, with the settled groups they share
+        deferred = handle_schedule_change(schedule, entry["src"], group_log, only_groups=settled, batch=batch,
+                                          held_groups=unsettled, schedule_file=entry["file"])
+        dispatched = settled - deferred
+        # Pending changes are dropped only once they are delivered, so that a failed run retries them
+        batch.on_sent(lambda schedule_date=schedule_date, dispatched=dispatched: _settle(pending, schedule_date, dispatched))
+    batch.send()
+    _save_pending(pending)
+
+
+def plan_settled(group_log, schedules, src, store):
+    """
+    Updates that register_changes followed by dispatch_settled would send, without changing
+    anything on disk.
+
+    Args:
+        group_log: Directory for tracking group schedule changes
+        schedules: List of (schedule, file name in out_dir) tuples, empty to plan the pending changes only
+        src: Source file the schedules were converted from
+        store: Subscriber registry to plan with, a snapshot as it is changed
+
+    Returns:
+        list: (schedule, PlannedUpdate) tuples
+    """
+    pending = _load_pending()
+    now = time.time()
+    _register(pending, schedules, src, store, now)
+    schedules_by_file = {file_name: schedule for schedule, file_name in schedules}
+    planned = []
+    for schedule_date, entry, settled, unsettled in _settled(pending, now):
+        schedule = _pending_schedule(entry, schedules_by_file)
+        if schedule is None:
+            continue
+        plan, _, _ = plan_schedule_change(schedule, group_log, only_groups=settled, dry_run=True,
+                                          held_groups=unsettled, store=store)
+        planned.extend((schedule, update) for update in plan)
+    return planned
+
+
+def _settle(pending, schedule_date, settled):
+    entry = pending[schedule_date]
+    remaining = {group: state for group, state in entry["groups"].items() if group not in settled}
+    if remaining:
+        entry["groups"] = remaining
+    else:
+        del pending[schedule_date]
@@ -14,15 +14,19 @@ class Config:
             cls._instance.out_dir = None
             cls._instance.group_log = None
             cls._instance.mode = None
+            cls._instance.shard_index = 0
+            cls._instance.shard_count = 1
         return cls._instance
     
-    def initialize(self, input_dir, src, out_dir, group_log, mode):
+    def initialize(self, input_dir, src, out_dir, group_log, mode, shard_index=0, shard_count=1):
         """Initialize configuration with provided values."""
         self.input_dir = input_dir
         self.src = src
         self.out_dir = out_dir
         self.group_log = group_log
         self.mode = mode
+        self.shard_index = shard_index
+        self.shard_count = shard_count
 
 
 # Global config instance
@@ -0,0 +1,63 @@
+"""Fingerprints of the blackout hours in supplier payloads, to recognize runs with nothing new."""
+import json
+import logging
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from config import config
+from sharding import shard_file_name
+
+logger = logging.getLogger(__name__)
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+FINGERPRINTS_FILE_NAME = 'schedule-fingerprints.json'
+
+# Hour statuses as the converter tells them apart, any other status is a blackout
+STATUS_CODES = {"yes": "y", "first": "f", "second": "s"}
+BLACKOUT_CODE = "n"
+MISSING_CODE = "-"
+
+
+def payload_fingerprints(json_path):
+    """
+    Canonical form of the status grid of a supplier file, independent of the update time,
+    the today field and the key order.
+
+    Returns:
+        dict: date (DD.MM.YYYY) -> group -> one status code per hour 1-24
+    """
+    with open(json_path, 'r') as f:
+        supplier_data = json.load(f)
+    fingerprints = {}
+    for timestamp, day_data in supplier_data.get("data", {}).items():
+        date_time = datetime.fromtimestamp(int(timestamp), tz=KYIV_TZ).date().strftime("%d.%m.%Y")
+        fingerprints[date_time] = {
+            group_key.replace("GPV", ""): ''.join(
+                STATUS_CODES.get(hours[str(hour)], BLACKOUT_CODE) if str(hour) in hours else MISSING_CODE
+                for hour in range(1, 25))
+            for group_key, hours in day_data.items()
+        }
+    return fingerprints
+
+
+def _fingerprints_path():
+    return os.path.join(config.out_dir, shard_file_name(FINGERPRINTS_FILE_NAME))
+
+
+def load_fingerprints():
+    """Fingerprints of the last file processed by this shard."""
+    fingerprints_path = _fingerprints_path()
+    if not os.path.exists(fingerprints_path):
+        return None
+    with open(fingerprints_path, 'r') as f:
+        return json.load(f)
+
+
+def save_fingerprints(fingerprints):
+    fingerprints_path = _fingerprints_path()
+    tmp_path = f"{fingerprints_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(fingerprints, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, fingerprints_path)
@@ -0,0 +1,193 @@
+"""In-process reader of the date box on supplier schedule images."""
+import logging
+import os
+import re
+import cv2
+import numpy as np
+import pytesseract
+from config import config
+
+logger = logging.getLogger(__name__)
+
+GLYPH_TEMPLATES_FILE_NAME = 'glyph-templates.npz'
+
+# Text the date box may contain, anything else is not trusted and not learned from
+DATE_TIME_PATTERN = re.compile(r'^\d{2}\.\d{2}\.\d{4}( \d{2}:\d{2})?$')
+# Lowest correlation with a template at which a glyph is accepted without Tesseract
+MIN_CONFIDENCE = float(os.getenv('GLYPH_MIN_CONFIDENCE') or 0.8)
+# Size glyphs are normalized to before matching: width, height
+TEMPLATE_SIZE = (12, 20)
+# Glyphs further apart than this share of the text height are separated by a space
+SPACE_GAP = 0.4
+# Page segmentation modes of the extra Tesseract runs that must agree before a text the
+# templates did not read the same way is learned from
+VERIFY_PSMS = ('7', '13')
+
+
+def segment_glyphs(box_image):
+    """
+    Cut the text of the date box into glyphs.
+
+    The box border touches the edges of the image and is dropped. Parts of a glyph stacked
+    above each other, like the dots of a colon, are merged.
+
+    Returns:
+        list: (normalized glyph, space before it) tuples, left to right
+    """
+    gray = cv2.cvtColor(box_image, cv2.COLOR_BGR2GRAY) if box_image.ndim == 3 else box_image
+    _, binary_image = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    height, width = binary_image.shape
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary_image)
+
+    parts = []
+    for x, y, w, h, area in stats[1:count]:
+        if x == 0 or y == 0 or x + w == width or y + h == height or area < 2:
+            continue
+        parts.append([x, y, x + w, y + h])
+    if not parts:
+        return []
+
+    parts.sort()
+    glyph_boxes = [parts[0]]
+    for x0, y0, x1, y1 in parts[1:]:
+        last = glyph_boxes[-1]
+        if x0 < last[2]:
+            glyph_boxes[-1] = [min(last[0], x0), min(last[1], y0), max(last[2], x1), max(last[3], y1)]
+        else:
+            glyph_boxes.append([x0, y0, x1, y1])
+
+    # Glyphs are cut to the full height of the text so that dots keep their position
+    top = min(box[1] for box in glyph_boxes)
+    bottom = max(box[3] for box in glyph_boxes)
+    text_height = bottom - top
+    glyphs = []
+    previous_x1 = None
+    for x0, _, x1, _ in glyph_boxes:
+        glyph = cv2.resize(binary_image[top:bottom, x0:x1], TEMPLATE_SIZE, interpolation=cv2.INTER_AREA)
+        space_before = previous_x1 is not None and x0 - previous_x1 > SPACE_GAP * text_height
+        glyphs.append((glyph.astype(np.float32) / 255, space_before))
+        previous_x1 = x1
+    return glyphs
+
+
+def _correlation(glyph, templates):
+    glyph = glyph.ravel() - glyph.mean()
+    centered = templates.reshape(len(templates), -1)
+    centered = centered - centered.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1) * np.linalg.norm(glyph)
+    return np.divide(centered @ glyph, norms, out=np.zeros(len(templates), dtype=np.float32), where=norms > 0)
+
+
+class GlyphReader:
+    """
+    Template matcher for the characters of the date box. A template is the mean of all
+    the glyphs learned for a character.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.chars = []
+        self._sums = np.zeros((0, TEMPLATE_SIZE[1], TEMPLATE_SIZE[0]), dtype=np.float32)
+        self._counts = np.zeros(0, dtype=np.int64)
+        if path and os.path.exists(path):
+            with np.load(path) as data:
+                self.chars = [str(char) for char in data['chars']]
+                self._sums = data['sums']
+                self._counts = data['counts']
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, chars=np.array(self.chars), sums=self._sums, counts=self._counts)
+        os.replace(tmp_path, self.path)
+
+    def read(self, box_image):
+        """
+        Returns:
+            tuple: (text, confidence), confidence is the lowest glyph score, 0 without templates
+        """
+        glyphs = segment_glyphs(box_image)
+        if not glyphs or not self.chars:
+            return None, 0.0
+        templates = self._sums / self._counts[:, None, None]
+        text = []
+        confidence = 1.0
+        for glyph, space_before in glyphs:
+            scores = _correlation(glyph, templates)
+            best = int(np.argmax(scores))
+            confidence = min(confidence, float(scores[best]))
+            text.append((' ' if space_before else '') + self.chars[best])
+        return ''.join(text), confidence
+
+    def learn(self, box_image, text):
+        """
+        Add the glyphs of a box whose text is known.
+
+        Returns:
+            bool: False when the glyphs could not be matched to the characters of the text
+        """
+        glyphs = segment_glyphs(box_image)
+        chars = text.replace(' ', '')
+        if len(glyphs) != len(chars):
+            return False
+        for (glyph, _), char in zip(glyphs, chars):
+            if char not in self.chars:
+                self.chars.append(char)
+                self._sums = np.concatenate([self._sums, np.zeros((1, *self._sums.shape[1:]), dtype=np.float32)])
+                self._counts = np.append(self._counts, 0)
+            index = self.chars.index(char)
+            self._sums[index] += glyph
+            self._counts[index] += 1
+        return True
+
+
+_reader = None
+
+
+def templates_path():
+    if os.getenv('GLYPH_TEMPLATES'):
+        return os.getenv('GLYPH_TEMPLATES')
+    return os.path.join(config.out_dir, GLYPH_TEMPLATES_FILE_NAME) if config.out_dir else None
+
+
+def _get_reader():
+    global _reader
+    if _reader is None or _reader.path != templates_path():
+        _reader = GlyphReader(templates_path())
+    return _reader
+
+
+def _tesseract(box_image, psm):
+    return pytesseract.image_to_string(box_image, config=f'--psm {psm}').strip()
+
+
+def _verified(box_image, text, template_text):
+    # A single misread learned from would make the templates repeat it with full confidence
+    if text == template_text:
+        return True
+    return all(_tesseract(box_image, psm) == text for psm in VERIFY_PSMS)
+
+
+def read_date_time(box_image):
+    """
+    Read the text of the date box, with Tesseract only when the templates are not confident.
+
+    Tesseract results that look like a date teach the templates, so that later images are
+    read in-process. They are learned from only when the templates read the same text, or when
+    Tesseract reads it the same way in every VERIFY_PSMS mode too.
+    """
+    reader = _get_reader()
+    template_text, confidence = reader.read(box_image)
+    if template_text is not None and confidence >= MIN_CONFIDENCE and DATE_TIME_PATTERN.match(template_text):
+        return template_text
+
+    logger.info(f"Reading the date box with Tesseract, template confidence: {confidence:.2f}")
+    text = _tesseract(box_image, 6)
+    if not DATE_TIME_PATTERN.match(text):
+        return text
+    if not _verified(box_image, text, template_text):
+        logger.warning(f"Not learning from {text!r}, Tesseract runs disagree and the templates read {template_text!r}")
+    elif reader.learn(box_image, text):
+        reader.save()
+    return text
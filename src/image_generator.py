@@ -1,6 +1,7 @@
 import logging
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont
+import io
 import os
 from zoneinfo import ZoneInfo
 
@@ -9,33 +10,22 @@ logger = logging.getLogger(__name__)
 # Europe/Kyiv timezone
 KYIV_TZ = ZoneInfo("Europe/Kyiv")
 
+# The table is drawn in shades of gray only, so a 16-entry palette (4 bits per pixel)
+# keeps antialiased text visually identical to the full-color rendering
+PALETTE_COLORS = 16
 
-def generate_schedule_table_image(schedule, output_path, groups=None):
+
+def render_schedule_table(schedule, groups=None):
     """
-    Generates a table image with blackout schedule.
+    Draws the blackout schedule table.
     Supports half-hour granularity - cells can be filled fully, half (left or right), or not at all.
     
     Args:
-        schedule: Dictionary with schedule in format:
-            {
-                "date_time": "30.10.2025 08:12",
-                "blackouts": {
-                    "1.1": [{"start": datetime, "end": datetime}, ...],
-                    "2.1": [...]
-                }
-            }
-            or with bit_masks:
-            {
-                "date_time": "30.10.2025 08:12",
-                "bit_masks": {
-                    "1.1": "000000000000000000000000",
-                    "2.1": "000000000000000000000000"
-                }
-            }
-        output_path: Path to save the image
+        schedule: Schedule, see generate_schedule_table_image
+        groups: Groups to show as table rows, all groups from the schedule by default
     
     Returns:
-        str: Path to the saved image
+        PIL.Image.Image: Grayscale ("L" mode) table image
     """
     
     # Table parameters
@@ -49,7 +39,7 @@ def generate_schedule_table_image(schedule, output_path, groups=None):
     # Get groups
     
     if not groups:
-        groups = sorted(schedule["blackouts"].keys())
+        groups = sorted(group for group, mask in schedule.masks.items() if mask)
     
     hours = list(range(24))
     
@@ -57,8 +47,8 @@ def generate_schedule_table_image(schedule, output_path, groups=None):
     width = GROUP_COLUMN_WIDTH + len(hours) * CELL_WIDTH + BORDER_WIDTH
     height = HEADER_HEIGHT + len(groups) * CELL_HEIGHT + BORDER_WIDTH + TITLE_Y + 10
     
-    # Create image
-    img = Image.new('RGB', (width, height), color='white')
+    # Create image. Every color used below is a shade of gray
+    img = Image.new('L', (width, height), color='white')
     draw = ImageDraw.Draw(img)
     
     
@@ -67,7 +57,7 @@ def generate_schedule_table_image(schedule, output_path, groups=None):
     cell_font = ImageFont.load_default(14)
     
     # Draw header with date
-    date_time_str = schedule.get("date_time", "")
+    date_time_str = schedule.date_time
     draw.text((width // 2, TITLE_Y), date_time_str, fill='black', 
               font=title_font, anchor='mt')
     
@@ -79,43 +69,11 @@ def generate_schedule_table_image(schedule, output_path, groups=None):
         draw.text((x + CELL_WIDTH // 2, y), hour_text, fill='black', 
                   font=header_font, anchor='mm')
     
-    # Convert schedule to half-hour bitmasks for convenience
     # Each hour has 2 half-hour periods: 0 = no blackout, 1 = first half, 2 = second half, 3 = full hour
-    group_half_hour_masks = {}
-    
-    # Convert blackouts to half-hour bitmasks
-    for group in groups:
-        # Store as list of 24 values, each 0-3 representing state of that hour
-        half_hour_mask = [0] * 24
-        
-        if group in schedule["blackouts"]:
-            for blackout in schedule["blackouts"][group]:
-                start_dt = blackout["start"]
-                end_dt = blackout["end"]
-                
-                # Calculate start half-hour slot (0-47)
-                start_half_hour = start_dt.hour * 2 + (1 if start_dt.minute >= 30 else 0)
-                
-                # Calculate end half-hour slot (0-48, where 48 = midnight next day)
-                if end_dt.date() > start_dt.date() and end_dt.hour == 0 and end_dt.minute == 0:
-                    end_half_hour = 48
-                else:
-                    end_half_hour = end_dt.hour * 2 + (1 if end_dt.minute >= 30 else 0)
-                
-                # Mark affected hours
-                for half_hour_slot in range(start_half_hour, end_half_hour):
-                    if half_hour_slot < 48:
-                        hour_index = half_hour_slot // 2
-                        is_first_half = (half_hour_slot % 2 == 0)
-                        
-                        if is_first_half:
-                            # Mark first half (add 1)
-                            half_hour_mask[hour_index] |= 1
-                        else:
-                            # Mark second half (add 2)
-                            half_hour_mask[hour_index] |= 2
-        
-        group_half_hour_masks[group] = half_hour_mask
+    group_half_hour_masks = {
+        group: [schedule.mask(group) >> (2 * hour) & 3 for hour in hours]
+        for group in groups
+    }
     
     # Draw table
     for row_idx, group in enumerate(groups):
@@ -205,6 +163,60 @@ def generate_schedule_table_image(schedule, output_path, groups=None):
     draw.rectangle([(0, 0), (width - 1, height - 1)], 
                    outline='black', width=BORDER_WIDTH)
     
+    return img
+
+
+def encode_schedule_table_png(img):
+    """
+    Encodes the table image as a compact palette-mode PNG.
+    
+    Returns:
+        bytes: PNG file content
+    """
+    buffer = io.BytesIO()
+    img.quantize(colors=PALETTE_COLORS).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def generate_schedule_table_image(schedule, output_path, groups=None):
+    """
+    Generates a table image with blackout schedule.
+    Supports half-hour granularity - cells can be filled fully, half (left or right), or not at all.
+    
+    Args:
+        schedule: Schedule with the half-hour blackout masks of the groups, see schedule_model
+        output_path: Path to save the image
+    
+    Returns:
+        str: Path to the saved image
+    """
+    img = render_schedule_table(schedule, groups)
+    png_bytes = encode_schedule_table_png(img)
+    return _save_png(png_bytes, schedule, output_path)
+
+
+def schedule_table_png(schedule, groups=None, archive_path=None):
+    """
+    Renders the table image as PNG bytes that can be uploaded without going through the disk.
+
+    Args:
+        schedule: Schedule as for generate_schedule_table_image
+        groups: Groups to show, all by default
+        archive_path: If set, the image is also saved there, with the schedule date in the name
+
+    Returns:
+        bytes: PNG file content
+    """
+    png_bytes = encode_schedule_table_png(render_schedule_table(schedule, groups))
+    logger.info(f"Schedule table image for {schedule.date_time} rendered ({len(png_bytes)} bytes)")
+    if archive_path:
+        _save_png(png_bytes, schedule, archive_path)
+    return png_bytes
+
+
+def _save_png(png_bytes, schedule, output_path):
+    date_time_str = schedule.date_time
+
     # Save image
     os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else '.', exist_ok=True)
     if date_time_str:
@@ -218,7 +230,8 @@ def generate_schedule_table_image(schedule, output_path, groups=None):
         except ValueError:
             logger.warning(f"Could not parse date_time: {date_time_str}")
     
-    img.save(output_path)
-    logger.info(f"Schedule table image saved to: {output_path}")
+    with open(output_path, 'wb') as f:
+        f.write(png_bytes)
+    logger.info(f"Schedule table image saved to: {output_path} ({len(png_bytes)} bytes)")
     
     return output_path
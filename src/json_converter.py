@@ -1,8 +1,8 @@
 import json
 import logging
-from datetime import datetime, time, timedelta
-from collections import defaultdict
+from datetime import datetime
 from zoneinfo import ZoneInfo
+from schedule_model import SLOTS_PER_DAY, Schedule
 
 logger = logging.getLogger(__name__)
 
@@ -26,14 +26,10 @@ def convert_supplier_json_to_internal(json_path):
         "today": timestamp
     }
     
-    Internal format:
-    {
-        "date_time": "DD.MM.YYYY HH:MM",
-        "blackouts": {
-            "1.1": [{"start": datetime, "end": datetime}, ...],
-            ...
-        }
-    }
+    Internal format: one Schedule per date, see schedule_model.
+
+    Returns:
+        list: Schedule objects
     """
     logger.info(f"Converting supplier JSON from: {json_path}")
     
@@ -47,10 +43,7 @@ def convert_supplier_json_to_internal(json_path):
     for timestamp, day_data in supplier_data.get("data", {}).items():
         # Convert timestamp to Europe/Kyiv timezone
         date_time = datetime.fromtimestamp(int(timestamp), tz=KYIV_TZ).date().strftime("%d.%m.%Y")
-        # Convert timestamp to date for datetime objects in Europe/Kyiv timezone
-        base_date = datetime.fromtimestamp(int(timestamp), tz=KYIV_TZ).date()
-        # Build internal format
-        blackouts = defaultdict(list)
+        masks = {}
         bit_masks = {}
         
         # Process each group
@@ -58,13 +51,15 @@ def convert_supplier_json_to_internal(json_path):
             # Convert "GPV1.1" to "1.1"
             internal_group = group_key.replace("GPV", "")
             
-            # Track blackout periods
-            start_time = None
+            # Track blackout periods as half-hour slots, hour strings are 1-24
+            start_slot = None
+            group_mask = 0
             group_bit_mask = 0
             
             for hour_str in sorted(hours.keys(), key=int):
                 hour = int(hour_str)
                 status = hours[hour_str]
+                first_half = 2 * (hour - 1)
                 
                 # "yes" means power is available (no blackout)
                 # "no" or "maybe" means blackout
@@ -72,61 +67,41 @@ def convert_supplier_json_to_internal(json_path):
 
                 if has_power:
                     # Power is available
-                    if start_time is not None:
+                    if start_slot is not None:
                         # End the blackout period
-                        end_time = datetime.combine(base_date, time(hour=(hour - 1) % 24, minute=0), tzinfo=KYIV_TZ)
-                        if hour == 24:
-                            end_time += timedelta(days=1)
-                        
-                        blackouts[internal_group].append({
-                            "start": start_time,
-                            "end": end_time
-                        })
-                        start_time = None
+                        group_mask |= (1 << first_half) - (1 << start_slot)
+                        start_slot = None
                 elif status == "first":
-                    if start_time:
+                    if start_slot is not None:
                         group_bit_mask |= (1 << (hour - 1))
-                        # End the previous blackout period
-                        end_time = datetime.combine(base_date, time(hour=(hour - 1) % 24, minute=30), tzinfo=KYIV_TZ)
-                        if hour == 24:
-                            end_time += timedelta(days=1)
-                        
-                        blackouts[internal_group].append({
-                            "start": start_time,
-                            "end": end_time
-                        })
-                        start_time = None
+                        # End the blackout period after the first half of the hour
+                        group_mask |= (1 << (first_half + 1)) - (1 << start_slot)
+                        start_slot = None
                         
                 elif status == "second":
-                    if start_time is None:
-                        # Start a new blackout period
-                        start_time = datetime.combine(base_date, time(hour=(hour - 1) % 24, minute=30), tzinfo=KYIV_TZ)
+                    if start_slot is None:
+                        # Start a new blackout period in the middle of the hour
+                        start_slot = first_half + 1
                         group_bit_mask |= (1 << (hour - 1))
                 else:
                     group_bit_mask |= (1 << (hour - 1))
                     # Blackout starts or continues
-                    if start_time is None:
-                        # Hour strings are 1-24, but datetime hours are 0-23
-                        start_time = datetime.combine(base_date, time(hour=(hour - 1) % 24, minute=0), tzinfo=KYIV_TZ)
-                        if hour == 24:
-                            start_time += timedelta(days=1)
+                    if start_slot is None:
+                        start_slot = first_half
             
             # Close any open blackout period at the end of the day
-            if start_time is not None:
-                end_time = datetime.combine(base_date, time(hour=23, minute=59), tzinfo=KYIV_TZ) + timedelta(minutes=1)
-                blackouts[internal_group].append({
-                    "start": start_time,
-                    "end": end_time
-                })
-            bit_masks[internal_group] = format(group_bit_mask, '024b')
+            if start_slot is not None:
+                group_mask |= (1 << SLOTS_PER_DAY) - (1 << start_slot)
+            masks[internal_group] = group_mask
+            bit_masks[internal_group] = group_bit_mask
         
-        internal_format = {
-            "date_time": date_time,
-            "blackouts": dict(blackouts),
-            "bit_masks": bit_masks,
-            "last_updated": last_updated
-        }
-        results.append(internal_format)
+        results.append(Schedule(date_time, masks, bit_masks, last_updated))
 
     logger.info(f"Converted schedule data from supplier JSON")
     return results
+
+
+def load_converted_schedule(file_path):
+    """Load a schedule saved by main.py in the internal format."""
+    with open(file_path, 'r') as f:
+        return Schedule.from_json(json.load(f))
@@ -5,35 +5,76 @@ load_dotenv()
 import argparse
 import os
 import glob
+from fnmatch import fnmatch
 import json
 import hashlib
-from schedule_handler import handle_schedule_change
+from coalescer import PENDING_FILE_NAME, dispatch_settled, plan_settled, register_changes
+from outbox import drain_outbox, OUTBOX_FILE_NAME
+from pipeline import DispatchPipeline
+from schedule_handler import build_message
+from tg import MESSAGE_META_FILE_NAME
+from sharding import shard_dir
+from archive import ARCHIVE_FILE_NAME, archive_schedules
+from subscribers import SUBSCRIBERS_DB_FILE_NAME, import_from_env, open_subscriber_snapshot, open_subscriber_store
 from json_converter import convert_supplier_json_to_internal
+from fingerprints import FINGERPRINTS_FILE_NAME, load_fingerprints, payload_fingerprints, save_fingerprints
+from poll_scheduler import POLL_STATE_FILE_NAME
 from config import config
 from datetime import timedelta
+from zoneinfo import ZoneInfo
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+
+def _service_file_pattern(file_name):
+    # Matches the file itself and its per-shard variants
+    base, ext = os.path.splitext(file_name)
+    return f"{base}*{ext}"
+
+
+# Service files in out_dir that must survive cleanup, for every shard
+OUT_DIR_SERVICE_FILES = ['meta_info.json',
+                         _service_file_pattern(MESSAGE_META_FILE_NAME),
+                         _service_file_pattern(OUTBOX_FILE_NAME),
+                         _service_file_pattern(PENDING_FILE_NAME),
+                         _service_file_pattern(FINGERPRINTS_FILE_NAME),
+                         _service_file_pattern(POLL_STATE_FILE_NAME),
+                         f"{SUBSCRIBERS_DB_FILE_NAME}*",
+                         # The archive and its lock file
+                         f"{ARCHIVE_FILE_NAME}*",
+                         # glyph_reader.GLYPH_TEMPLATES_FILE_NAME, not imported as it needs OpenCV
+                         'glyph-templates.npz']
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Process schedule data from image or JSON.')
     parser.add_argument('--input_dir', type=str, required=True, help='Directory containing the input images')
-    parser.add_argument('--src', type=str, required=True, help='Source image or JSON file')
+    parser.add_argument('--src', type=str, help='Source image or JSON file')
     parser.add_argument('--out_dir', type=str, required=True, help='Directory to save the json schedule')
     parser.add_argument('--group_log', type=str, required=True,
                         help='Service directory for tracking group schedule changes')
-    parser.add_argument('--mode', type=str, choices=['image', 'json', 'cleanup'], default='image',
-                        help='Processing mode: "image" for image recognition, "json" for supplier JSON conversion')
-    return parser.parse_args()
+    parser.add_argument('--mode', type=str, choices=['image', 'json', 'plan', 'flush', 'cleanup'], default='image',
+                        help='Processing mode: "image" for image recognition, "json" for supplier JSON conversion, '
+                             '"plan" to print the updates a supplier JSON file would send, without sending or saving anything, '
+                             '"flush" to dispatch settled pending changes and retry queued deliveries')
+    parser.add_argument('--shard_index', type=int, default=int(os.getenv('SHARD_INDEX') or 0),
+                        help='Index of this notifier instance, 0 <= shard_index < shard_count')
+    parser.add_argument('--shard_count', type=int, default=int(os.getenv('SHARD_COUNT') or 1),
+                        help='Total number of notifier instances sharing the subscribers')
+    args = parser.parse_args()
+    if args.mode in ('image', 'json', 'plan') and not args.src:
+        parser.error(f"--src is required in {args.mode} mode")
+    return args
 
 
 def remove_old_files(directory, exceptions=None, cutoff_days=2):
     logger.info(f"Removing old files in directory: {directory}, cutoff_days: {cutoff_days}")
-    resolved_exceptions = []
-    if exceptions:
-        resolved_exceptions = [os.path.join(directory, exc) for exc in exceptions]
-    files = glob.glob(os.path.join(directory, '*'))
+    exceptions = exceptions or []
+    files = [f for f in glob.glob(os.path.join(directory, '*')) if os.path.isfile(f)]
     current_time = datetime.now()
     cutoff_time = current_time - timedelta(days=cutoff_days)
     logger.info(f"Cutoff time: {cutoff_time}, timestamp: {cutoff_time.timestamp()}")
@@ -41,22 +82,22 @@ def remove_old_files(directory, exceptions=None, cutoff_days=2):
     files = [f for f in files if os.path.getmtime(f) < cutoff_time.timestamp()]
     logger.info(f"Files to be removed: {len(files)}")
     for file in files:
-        if file in resolved_exceptions:
+        if any(fnmatch(os.path.basename(file), exc) for exc in exceptions):
             continue
         logger.info(f"Removing old file: {file}")
-        os.remove(file)
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            # Already removed by another notifier instance
+            pass
 
 
-def time_converter(obj):
-    if isinstance(obj, datetime):
-        return obj.strftime("%H:%M")
-    raise TypeError("Type not serializable")
+def schedule_file_name(json_str):
+    return f"{hashlib.md5(json_str.encode()).hexdigest()}.json"
 
 
-def dump_json_to_file(json_data, directory):
-    json_str = json.dumps(json_data, sort_keys=True, default=time_converter)
-    md5_hash = hashlib.md5(json_str.encode()).hexdigest()
-    file_name = f"{md5_hash}.json"
+def dump_json_to_file(json_str, directory):
+    file_name = schedule_file_name(json_str)
     file_path = os.path.join(directory, file_name)
     logger.info(f"Saving schedule to: {file_path}")
 
@@ -64,8 +105,11 @@ def dump_json_to_file(json_data, directory):
         logger.info(f"File already exists: {file_path}")
         return file_name
 
-    with open(file_path, 'w') as json_file:
+    # Other notifier instances may be writing the same content-addressed file
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as json_file:
         json_file.write(json_str)
+    os.replace(tmp_path, file_path)
 
     logger.info(f"Schedule saved to: {file_path}")
     return file_name
@@ -81,11 +125,108 @@ def dump_meta_info(meta_info, out_dir):
         dates.sort()
         latest_dates = dates[-3:]
         meta_info = {date.strftime("%d.%m.%Y"): existing_meta[date.strftime("%d.%m.%Y")] for date in latest_dates}
-    with open(meta_file_path, 'w') as f:
+    tmp_path = f"{meta_file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
         json.dump(meta_info, f, indent=2)
+    os.replace(tmp_path, meta_file_path)
     logger.info(f"Meta info saved to: {meta_file_path}")
 
 
+def save_schedules(schedules, out_dir):
+    """
+    Save converted schedules to out_dir and point meta_info.json to them.
+
+    Returns:
+        list: (schedule, file name in out_dir) tuples
+    """
+    meta_info = {}
+    saved_schedules = []
+
+    for single_schedule in schedules:
+        file_name = dump_json_to_file(single_schedule.to_json(), out_dir)
+        meta_info[single_schedule.date_time] = file_name
+        saved_schedules.append((single_schedule, file_name))
+
+    dump_meta_info(meta_info, out_dir)
+    return saved_schedules
+
+
+def process_schedules(schedules, src, out_dir, group_log):
+    """
+    Save converted schedules to out_dir and dispatch the changes in them.
+
+    Args:
+        schedules: Schedules converted from the source file
+        src: Source file the schedules were converted from
+        out_dir: Directory to save the json schedules
+        group_log: Directory for tracking group schedule changes
+
+    Returns:
+        list: (schedule, file name in out_dir) tuples
+    """
+    archive_schedules(schedules)
+    saved_schedules = save_schedules(schedules, out_dir)
+
+    register_changes(saved_schedules, src)
+    with DispatchPipeline() as pipeline:
+        dispatch_settled(group_log, {file_name: single_schedule for single_schedule, file_name in saved_schedules}, pipeline)
+    return saved_schedules
+
+
+def process_supplier_json(src, out_dir, group_log, force=False):
+    """
+    Convert a supplier JSON file and dispatch the changes in it.
+
+    When the blackout hours of every group are the same as in the last file processed, only the
+    saved schedules are refreshed, e.g. with a new last_updated time. Pending changes that
+    have settled are still dispatched.
+
+    Args:
+        src: Supplier JSON file
+        out_dir: Directory to save the json schedules
+        group_log: Directory for tracking group schedule changes
+        force: Process the file in full even if the blackout hours are unchanged
+
+    Returns:
+        tuple: (list of (schedule, file name in out_dir) tuples, whether the blackout hours changed)
+    """
+    fingerprints = payload_fingerprints(src)
+    changed = force or fingerprints != load_fingerprints()
+    schedules = convert_supplier_json_to_internal(src)
+
+    if not changed:
+        logger.info("Blackout hours are the same as in the last processed file, refreshing the saved schedules only")
+        saved_schedules = save_schedules(schedules, out_dir)
+        with DispatchPipeline() as pipeline:
+            dispatch_settled(group_log, pipeline=pipeline)
+        return saved_schedules, False
+
+    saved_schedules = process_schedules(schedules, src, out_dir, group_log)
+    save_fingerprints(fingerprints)
+    return saved_schedules, True
+
+
+def plan_supplier_json(src, group_log):
+    """
+    Updates a json mode run with the supplier JSON file would send, without sending or saving
+    anything. Subscriptions from CHAT_ID_TO_BLACKOUT_GROUPS, unchanged files and changes that
+    have not settled are handled as in that run.
+
+    Returns:
+        list: (schedule, PlannedUpdate) tuples
+    """
+    with open_subscriber_snapshot() as store:
+        force = import_from_env(store) > 0
+        changed = force or payload_fingerprints(src) != load_fingerprints()
+        schedules = []
+        if changed:
+            schedules = [(schedule, schedule_file_name(schedule.to_json()))
+                         for schedule in convert_supplier_json_to_internal(src)]
+        else:
+            logger.info("Blackout hours are the same as in the last processed file, planning pending changes only")
+        return plan_settled(group_log, schedules, src, store)
+
+
 if __name__ == "__main__":
     args = parse_args()
     input_dir = args.input_dir
@@ -95,52 +236,64 @@ if __name__ == "__main__":
     mode = args.mode
     
     # Initialize global config
-    config.initialize(input_dir, src, out_dir, group_log, mode)
+    config.initialize(input_dir, src, out_dir, group_log, mode, args.shard_index, args.shard_count)
+    if not 0 <= config.shard_index < config.shard_count:
+        raise ValueError(f"Invalid shard {config.shard_index} of {config.shard_count}")
+    # Each shard keeps its own change hashes
+    group_log = shard_dir(group_log)
+    config.group_log = group_log
+    if mode != 'plan':
+        os.makedirs(group_log, exist_ok=True)
 
     logger.info(f"Input dir: {input_dir}")
     logger.info(f"Source: {src}")
     logger.info(f"Output dir: {out_dir}")
     logger.info(f"Group log: {group_log}")
     logger.info(f"Mode: {mode}")
+    logger.info(f"Shard: {config.shard_index} of {config.shard_count}")
 
     if mode == 'cleanup':
         logger.info("Running cleanup mode")
         remove_old_files(input_dir)
-        remove_old_files(out_dir, exceptions=['meta_info.json', 'telegram-meta-v2.json'])
+        remove_old_files(out_dir, exceptions=OUT_DIR_SERVICE_FILES)
         remove_old_files(group_log)
         exit(0)
+    elif mode == 'flush':
+        logger.info("Dispatching settled changes")
+        with DispatchPipeline() as pipeline:
+            dispatch_settled(group_log, pipeline=pipeline)
+        drain_outbox()
+        exit(0)
+    elif mode == 'plan':
+        logger.info("Planning updates for the supplier JSON file")
+        now_kyiv = datetime.now(KYIV_TZ)
+        for single_schedule, (chat_id, groups, change_hash_path) in plan_supplier_json(src, group_log):
+            message = build_message(single_schedule, groups, now_kyiv)
+            if message is None:
+                continue
+            print(json.dumps({
+                "date": single_schedule.date_time,
+                "chat_id": chat_id,
+                "groups": groups,
+                "change_hash": os.path.basename(change_hash_path),
+                "message": message,
+            }, ensure_ascii=False))
+        exit(0)
     elif mode == 'image':
         logger.info("Processing image with OCR recognition")
         # schedule = recognize(src)
         raise NotImplementedError("Image recognition mode is not implemented yet.")
     elif mode == 'json':
         logger.info("Processing supplier JSON file")
-        schedule = convert_supplier_json_to_internal(src)
+        with open_subscriber_store() as store:
+            # New subscribers get the current schedule even if it has not changed
+            subscriptions_changed = import_from_env(store) > 0
+        process_supplier_json(src, out_dir, group_log, force=subscriptions_changed)
     else:
         raise ValueError(f"Unknown mode: {mode}")
 
-    meta_info = {}
-
-    if isinstance(schedule, list):
-        for single_schedule in schedule:
-            file_name = dump_json_to_file(single_schedule, out_dir)
-            meta_info[single_schedule["date_time"]] = file_name
-            if file_name:
-                # if 'bit_masks' in single_schedule:
-                #     handle_schedule_changes_with_masks(single_schedule, src, group_log)
-                # else:
-                handle_schedule_change(single_schedule, src, group_log) 
-    else:
-        file_name = dump_json_to_file(schedule, out_dir)
-        meta_info[schedule["date_time"]] = file_name
-        if file_name:
-            # if 'bit_masks' in schedule:
-            #     handle_schedule_changes_with_masks(schedule, src, group_log)
-            # else:
-            handle_schedule_change(schedule, src, group_log)
-
-    dump_meta_info(meta_info, out_dir)
+    drain_outbox()
 
     remove_old_files(input_dir)
-    remove_old_files(out_dir, exceptions=['meta_info.json', 'telegram-meta-v2.json'])
-    remove_old_files(group_log)
\ No newline at end of file
+    remove_old_files(out_dir, exceptions=OUT_DIR_SERVICE_FILES)
+    remove_old_files(group_log)
@@ -0,0 +1,325 @@
+"""Durable outbox for Telegram deliveries with retry and backoff."""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from config import config
+from image_generator import schedule_table_png
+from json_converter import load_converted_schedule
+from sharding import shard_file_name
+import tg
+
+logger = logging.getLogger(__name__)
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+OUTBOX_FILE_NAME = 'telegram-outbox.json'
+# Images of deliveries waiting for a retry, named by their MD5 and removed by the regular cleanup
+OUTBOX_IMAGE_FILE_NAME = 'outbox-image-{md5}.png'
+
+# Longest flood-control wait honored in-process; longer ones are deferred to the next run
+MAX_RETRY_AFTER_SECONDS = int(os.getenv('OUTBOX_MAX_RETRY_AFTER_SECONDS') or 60)
+# In-process retries of a transient failure before the entry is deferred to the next run
+RETRIES_PER_RUN = int(os.getenv('OUTBOX_RETRIES_PER_RUN') or 3)
+# Total transient failures after which a delivery is dropped
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS') or 10)
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_CAP_SECONDS = 30.0
+
+# Deliveries can be queued and completed from different threads
+_outbox_lock = threading.Lock()
+# Chats with stored deliveries, with the modification time of the outbox they were read from
+_stored_chats = (None, frozenset())
+
+
+def _outbox_path():
+    return os.path.join(config.out_dir, shard_file_name(OUTBOX_FILE_NAME))
+
+
+def _load_outbox():
+    outbox_path = _outbox_path()
+    if not os.path.exists(outbox_path):
+        return []
+    with open(outbox_path, 'r') as f:
+        return json.load(f)
+
+
+def _chats_in_outbox():
+    """Chats that have deliveries stored in the outbox, read again only when the file changes."""
+    global _stored_chats
+    try:
+        mtime = os.stat(_outbox_path()).st_mtime_ns
+    except FileNotFoundError:
+        return frozenset()
+    if _stored_chats[0] != mtime:
+        _stored_chats = (mtime, frozenset(entry["chat_id"] for entry in _load_outbox()))
+    return _stored_chats[1]
+
+
+def _spill_images(entry):
+    """
+    Write in-memory images of the entry to out_dir so that it can be stored as JSON.
+
+    Returns:
+        dict: The entry as stored, the in-memory entry keeps its images for the upload
+    """
+    if "items" not in entry:
+        return entry
+    items = []
+    for item in entry["items"]:
+        image_bytes = item.get("image_bytes")
+        if image_bytes is not None:
+            image_path = os.path.join(config.out_dir, OUTBOX_IMAGE_FILE_NAME.format(md5=hashlib.md5(image_bytes).hexdigest()))
+            if not os.path.exists(image_path):
+                tmp_path = f"{image_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(image_bytes)
+                os.replace(tmp_path, image_path)
+            item = {key: value for key, value in item.items() if key != "image_bytes"}
+            item["image_path"] = image_path
+        items.append(item)
+    return {**entry, "items": items}
+
+
+def _save_outbox(entries):
+    stored_entries = [_spill_images(entry) for entry in entries]
+    outbox_path = _outbox_path()
+    tmp_path = f"{outbox_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(stored_entries, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, outbox_path)
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def mark_delivered(dedupe_path):
+    """Record the change hash once the chat has actually received the update."""
+    if not dedupe_path:
+        return
+    with open(dedupe_path, 'w') as f:
+        f.write(str(int(datetime.now().timestamp())))
+
+
+def _entry_items(entry):
+    # Entries queued before albums were supported hold a single update
+    if "items" in entry:
+        return entry["items"]
+    return [{key: entry[key] for key in ("image_path", "message_text", "schedule_date", "dedupe_path")}]
+
+
+def _new_entry(chat_id, updates):
+    items = []
+    for image, message_text, schedule_date_time, dedupe_path, table in updates:
+        item = {
+            "image_path": None if isinstance(image, bytes) else image,
+            "message_text": message_text,
+            "schedule_date": schedule_date_time.strftime("%d.%m.%Y"),
+            "dedupe_path": dedupe_path,
+            "table": table,
+        }
+        if isinstance(image, bytes):
+            item["image_bytes"] = image
+        items.append(item)
+    return {
+        "id": uuid.uuid4().hex,
+        "chat_id": str(chat_id),
+        "items": items,
+        "attempts": 0,
+        "next_attempt_at": 0,
+    }
+
+
+def _supersede(entries, new_entry):
+    """Drop the items of pending entries that the new entry delivers a later version of."""
+    schedule_dates = {item["schedule_date"] for item in new_entry["items"]}
+    remaining_entries = []
+    for e in entries:
+        if e["chat_id"] == new_entry["chat_id"]:
+            remaining = [item for item in _entry_items(e) if item["schedule_date"] not in schedule_dates]
+            if not remaining:
+                continue
+            e = {**e, "items": remaining}
+        remaining_entries.append(e)
+    return remaining_entries
+
+
+def enqueue_delivery(chat_id, updates):
+    """
+    Persist a delivery in the outbox. The updates of several dates are delivered together,
+    as one album.
+
+    Pending updates for the same chat and dates are superseded, so only the latest
+    version of a schedule is ever sent.
+
+    Args:
+        chat_id: Chat to deliver to
+        updates: List of (image path or bytes, message_text, schedule_date_time, dedupe_path, table) tuples,
+            table is a {"schedule_file", "groups"} reference the image can be rendered again from, or None
+    """
+    entry = _new_entry(chat_id, updates)
+    with _outbox_lock:
+        entries = _supersede(_load_outbox(), entry)
+        entries.append(entry)
+        _save_outbox(entries)
+    logger.info(f"Queued delivery for chat_id: {chat_id}, dates: {[item['schedule_date'] for item in entry['items']]}")
+    return entry
+
+
+def _complete(entry, keep):
+    """Remove the entry from the outbox, or store its retry state when keep is set."""
+    with _outbox_lock:
+        entries = [e for e in _load_outbox() if e["id"] != entry["id"]]
+        if keep:
+            entries.append(entry)
+        _save_outbox(entries)
+
+
+def _stored_image(item):
+    """Image of a stored item, rendered again from its schedule when the copy was cleaned up."""
+    image_path = item["image_path"]
+    table = item.get("table")
+    if (image_path and os.path.exists(image_path)) or not table:
+        return image_path
+    try:
+        schedule = load_converted_schedule(os.path.join(config.out_dir, table["schedule_file"]))
+    except FileNotFoundError:
+        logger.warning(f"Table image and schedule of a stored delivery are gone, sending text only: {table}")
+        return None
+    return schedule_table_png(schedule, table["groups"])
+
+
+def _deliver(entry):
+    items = [(item.get("image_bytes") or _stored_image(item), item["message_text"],
+              datetime.strptime(item["schedule_date"], "%d.%m.%Y").replace(tzinfo=KYIV_TZ))
+             for item in _entry_items(entry)]
+    if len(items) == 1:
+        tg.post_message_with_image(entry["chat_id"], *items[0])
+    else:
+        tg.post_album(entry["chat_id"], items)
+
+
+def _try_deliver(entry):
+    """
+    Deliver one entry, retrying transient failures in-process.
+
+    Returns:
+        str: 'sent', 'deferred' or 'failed'
+    """
+    retries = 0
+    while True:
+        try:
+            _deliver(entry)
+            return 'sent'
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            if delay > MAX_RETRY_AFTER_SECONDS:
+                logger.warning(f"Flood control for chat {entry['chat_id']} asks for {delay}s, deferring delivery")
+                entry["next_attempt_at"] = time.time() + delay
+                return 'deferred'
+            logger.warning(f"Flood control for chat {entry['chat_id']}, retrying in {delay}s")
+            time.sleep(delay)
+        except BadRequest as e:
+            logger.error(f"Delivery to chat {entry['chat_id']} rejected: {e}")
+            return 'failed'
+        except NetworkError as e:
+            entry["attempts"] += 1
+            retries += 1
+            if entry["attempts"] >= MAX_ATTEMPTS:
+                logger.error(f"Giving up on delivery to chat {entry['chat_id']} after {entry['attempts']} attempts: {e}")
+                return 'failed'
+            delay = backoff_delay(entry["attempts"])
+            if retries > RETRIES_PER_RUN:
+                logger.warning(f"Delivery to chat {entry['chat_id']} still failing, deferring: {e}")
+                entry["next_attempt_at"] = time.time() + delay
+                return 'deferred'
+            logger.warning(f"Transient error for chat {entry['chat_id']}, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+        except TelegramError as e:
+            logger.error(f"Delivery to chat {entry['chat_id']} rejected: {e}")
+            return 'failed'
+
+
+def deliver_entry(entry):
+    """
+    Deliver a queued entry now and update the outbox with the outcome.
+
+    Returns:
+        str: 'sent', 'deferred' or 'failed'
+    """
+    result = _try_deliver(entry)
+    if result == 'sent':
+        for item in _entry_items(entry):
+            mark_delivered(item["dedupe_path"])
+    _complete(entry, keep=result == 'deferred')
+    return result
+
+
+def deliver_updates(chat_id, updates):
+    """
+    Deliver updates right away, from memory. The outbox is written only when the delivery is
+    deferred to a later run, or when it supersedes deliveries stored for the chat before.
+
+    A delivery lost with the process is not lost for the chat: the dispatch is recorded only
+    once its deliveries are sent or stored, so the next run plans it again.
+
+    Args:
+        chat_id: Chat to deliver to
+        updates: As for enqueue_delivery
+
+    Returns:
+        str: 'sent', 'deferred' or 'failed'
+    """
+    entry = _new_entry(chat_id, updates)
+    result = _try_deliver(entry)
+    if result == 'sent':
+        for item in entry["items"]:
+            mark_delivered(item["dedupe_path"])
+    if result == 'deferred' or entry["chat_id"] in _chats_in_outbox():
+        with _outbox_lock:
+            entries = _supersede(_load_outbox(), entry)
+            if result == 'deferred':
+                entries.append(entry)
+            _save_outbox(entries)
+    return result
+
+
+def drain_outbox():
+    """Send every due delivery from the outbox. Returns the number of deliveries sent."""
+    entries = _load_outbox()
+    if not entries:
+        return 0
+    logger.info(f"Draining outbox: {len(entries)} pending deliveries")
+    today = datetime.now(KYIV_TZ).date()
+    sent = 0
+    for entry in entries:
+        items = [item for item in _entry_items(entry)
+                 if datetime.strptime(item["schedule_date"], "%d.%m.%Y").date() >= today]
+        if not items:
+            logger.info(f"Dropping outdated delivery for chat {entry['chat_id']}")
+            _complete(entry, keep=False)
+            continue
+        entry = {**entry, "items": items}
+        if entry["next_attempt_at"] > time.time():
+            continue
+        if deliver_entry(entry) == 'sent':
+            sent += 1
+    logger.info(f"Outbox drained: {sent} sent, {len(_load_outbox())} pending")
+    return sent
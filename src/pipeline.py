@@ -0,0 +1,109 @@
+"""Pipelined rendering and delivery of schedule updates."""
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from image_generator import schedule_table_png
+from outbox import deliver_updates
+
+logger = logging.getLogger(__name__)
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS') or min(os.cpu_count() or 1, 4))
+# Rendered deliveries waiting for the sender; the handler blocks when the sender falls behind
+DISPATCH_QUEUE_SIZE = int(os.getenv('DISPATCH_QUEUE_SIZE') or 16)
+
+_STOP = object()
+
+
+class DispatchPipeline:
+    """
+    Two-stage dispatch: table images are rendered in a process pool while a sender
+    thread sends the updates whose images are ready, in submission order. Images are
+    passed as PNG bytes and uploaded straight from memory.
+
+    Each distinct table (same date and groups) is rendered once and shared
+    by every chat that needs it.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, queue_size=DISPATCH_QUEUE_SIZE):
+        self.workers = workers
+        self._pool = None
+        self._renders = {}
+        self._ready = queue.Queue(maxsize=queue_size)
+        self._sender = threading.Thread(target=self._send_loop, name='dispatch-sender', daemon=True)
+        self._sender.start()
+        self.results = {'sent': 0, 'deferred': 0, 'failed': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def render(self, schedule, archive_path, groups):
+        """
+        Start rendering a table image.
+
+        Args:
+            archive_path: Where to also save the image, None to keep it in memory only
+
+        Returns:
+            concurrent.futures.Future: Resolves to the PNG bytes
+        """
+        key = (archive_path, schedule.date_time, tuple(groups))
+        if key not in self._renders:
+            if self._pool is None:
+                # Spawned workers don't inherit locks held by the sender thread
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            self._renders[key] = self._pool.submit(schedule_table_png, schedule, groups, archive_path)
+        return self._renders[key]
+
+    def deliver(self, chat_id, updates):
+        """
+        Queue a delivery to be sent as soon as its images are rendered.
+
+        Args:
+            chat_id: Chat to deliver to
+            updates: List of (image future, message_text, schedule_date_time, dedupe_path, table) tuples
+
+        Returns:
+            concurrent.futures.Future: Resolves to 'sent', 'deferred' or 'failed' once the delivery
+                is handled, or to the exception that kept it from reaching the outbox
+        """
+        delivery = Future()
+        self._ready.put((chat_id, updates, delivery))
+        return delivery
+
+    def _send_loop(self):
+        while True:
+            item = self._ready.get()
+            if item is _STOP:
+                return
+            chat_id, updates, delivery = item
+            try:
+                rendered = []
+                for image_future, message_text, schedule_date_time, dedupe_path, table in updates:
+                    try:
+                        image = image_future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to render table for chat {chat_id}, sending text only: {e}")
+                        image = None
+                    rendered.append((image, message_text, schedule_date_time, dedupe_path, table))
+                result = deliver_updates(chat_id, rendered)
+                self.results[result] += 1
+                delivery.set_result(result)
+            except Exception as e:
+                logger.error(f"Failed to deliver update to chat {chat_id}: {e}")
+                self.results['failed'] += 1
+                delivery.set_exception(e)
+
+    def close(self):
+        """Wait until every queued delivery is handled."""
+        self._ready.put(_STOP)
+        self._sender.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+        logger.info(f"Dispatch pipeline finished: {self.results}")
@@ -0,0 +1,173 @@
+"""Adaptive schedule of supplier polls, learned from the times new inputs were downloaded."""
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from config import config
+from sharding import shard_file_name
+
+logger = logging.getLogger(__name__)
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+POLL_STATE_FILE_NAME = 'poll-state.json'
+
+# Interval between polls while an update is likely
+MIN_INTERVAL_SECONDS = int(os.getenv('POLL_MIN_INTERVAL_SECONDS') or 120)
+# Longest interval the quiet-period backoff may reach
+MAX_INTERVAL_SECONDS = int(os.getenv('POLL_MAX_INTERVAL_SECONDS') or 1800)
+# The supplier often publishes corrections soon after an update
+RECENT_CHANGE_SECONDS = int(os.getenv('POLL_RECENT_CHANGE_SECONDS') or 3600)
+# Only inputs downloaded within this many days are learned from
+HISTORY_DAYS = int(os.getenv('POLL_HISTORY_DAYS') or 28)
+# Share of the history days with an update at a time of day that makes it an update window
+WINDOW_MIN_SHARE = float(os.getenv('POLL_WINDOW_MIN_SHARE') or 0.2)
+WINDOW_SLOT_MINUTES = 30
+# Cron starts the check every minute, a poll that is due a few seconds later is not delayed a minute
+TICK_TOLERANCE_SECONDS = 30
+
+INPUT_PATTERNS = ('*.json', '*.png')
+
+
+def change_history(input_dir, known=(), now=None):
+    """
+    Times new inputs appeared, oldest first. Inputs are named by the MD5 of their content,
+    so every file is a change the supplier published. Inputs are removed after a couple of
+    days, so the times seen before are kept in the poll state and merged in.
+
+    Args:
+        input_dir: Directory with the downloaded inputs
+        known: Timestamps recorded by earlier checks
+
+    Returns:
+        list: POSIX timestamps within the last HISTORY_DAYS
+    """
+    now = now if now is not None else time.time()
+    since = now - HISTORY_DAYS * 86400
+    timestamps = set(known)
+    for pattern in INPUT_PATTERNS:
+        for input_path in glob.glob(os.path.join(input_dir, pattern)):
+            timestamps.add(os.path.getmtime(input_path))
+    return sorted(timestamp for timestamp in timestamps if since <= timestamp <= now)
+
+
+def _slot(timestamp):
+    local_time = datetime.fromtimestamp(timestamp, tz=KYIV_TZ)
+    return (local_time.hour * 60 + local_time.minute) // WINDOW_SLOT_MINUTES
+
+
+def update_windows(history):
+    """
+    Times of day at which the supplier tends to publish.
+
+    A slot is a window when updates fell into it, or next to it, on at least WINDOW_MIN_SHARE
+    of the days of the history, and on at least two days.
+
+    Returns:
+        set: Indexes of WINDOW_SLOT_MINUTES slots of the day in Kyiv time
+    """
+    if not history:
+        return set()
+    slots_per_day = 24 * 60 // WINDOW_SLOT_MINUTES
+    days_by_slot = defaultdict(set)
+    for timestamp in history:
+        day = datetime.fromtimestamp(timestamp, tz=KYIV_TZ).date()
+        slot = _slot(timestamp)
+        # Publication times drift, so an update also marks the neighbouring slots
+        for neighbour in (slot - 1, slot, slot + 1):
+            days_by_slot[neighbour % slots_per_day].add(day)
+    history_days = (history[-1] - history[0]) / 86400 + 1
+    min_days = max(2, WINDOW_MIN_SHARE * history_days)
+    return {slot for slot, days in days_by_slot.items() if len(days) >= min_days}
+
+
+def _state_path():
+    return os.path.join(config.out_dir, shard_file_name(POLL_STATE_FILE_NAME))
+
+
+def _load_state():
+    state_path = _state_path()
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def _save_state(state):
+    state_path = _state_path()
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def _busy_reason(history, now):
+    if history and now - history[-1] < RECENT_CHANGE_SECONDS:
+        return "recent change"
+    if _slot(now) in update_windows(history):
+        return "update window"
+    return None
+
+
+def check_poll(input_dir, now=None):
+    """
+    Decide whether the supplier should be polled now, and record the poll when it should.
+
+    Around likely update windows and after a recent change polls are MIN_INTERVAL_SECONDS
+    apart. Otherwise every poll doubles the interval, up to MAX_INTERVAL_SECONDS.
+
+    Returns:
+        bool: True when a poll is due
+    """
+    now = now if now is not None else time.time()
+    state = _load_state()
+    history = change_history(input_dir, state.get("history", ()), now)
+    reason = _busy_reason(history, now)
+    interval = MIN_INTERVAL_SECONDS if reason else state.get("interval", MIN_INTERVAL_SECONDS)
+    elapsed = now - state.get("last_poll", 0)
+    if elapsed + TICK_TOLERANCE_SECONDS < interval:
+        logger.debug(f"Next poll in {interval - elapsed:.0f}s")
+        return False
+
+    next_interval = MIN_INTERVAL_SECONDS
+    if not reason:
+        next_interval = max(MIN_INTERVAL_SECONDS, min(MAX_INTERVAL_SECONDS, interval * 2))
+    _save_state({"last_poll": now, "interval": next_interval, "history": history})
+    logger.info(f"Polling the supplier ({reason or 'quiet period'}), next poll in {next_interval}s")
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Exit with status 0 when the supplier should be polled now, 1 otherwise.')
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory with the downloaded inputs')
+    parser.add_argument('--out_dir', type=str, required=True, help='Directory to keep the poll state in')
+    parser.add_argument('--windows', action='store_true',
+                        help='Print the learned update windows instead of checking')
+    parser.add_argument('--shard_index', type=int, default=int(os.getenv('SHARD_INDEX') or 0),
+                        help='Index of this notifier instance, 0 <= shard_index < shard_count')
+    parser.add_argument('--shard_count', type=int, default=int(os.getenv('SHARD_COUNT') or 1),
+                        help='Total number of notifier instances sharing the subscribers')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    config.initialize(args.input_dir, None, args.out_dir, None, 'poll', args.shard_index, args.shard_count)
+
+    if args.windows:
+        history = change_history(args.input_dir, _load_state().get("history", ()))
+        for slot in sorted(update_windows(history)):
+            start = slot * WINDOW_SLOT_MINUTES
+            print(f"{start // 60:02d}:{start % 60:02d}")
+        exit(0)
+
+    exit(0 if check_poll(args.input_dir) else 1)
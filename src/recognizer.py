@@ -3,8 +3,8 @@ from datetime import time, datetime, timedelta
 from math import ceil
 import cv2
 import numpy as np
-import pytesseract
 from zoneinfo import ZoneInfo
+from glyph_reader import read_date_time
 
 # Europe/Kyiv timezone
 KYIV_TZ = ZoneInfo("Europe/Kyiv")
@@ -13,16 +13,73 @@ KYIV_TZ = ZoneInfo("Europe/Kyiv")
 num_groups = 12
 num_hours = 24
 
+# Width of the downscaled copy used to locate the table and the date box
+COARSE_WIDTH = 800
+# Padding around the located regions, in pixels of the downscaled copy
+COARSE_MARGIN = 2
+
+
+def _binarize(gray):
+    _, binary_image = cv2.threshold(gray, 250, 255, cv2.THRESH_BINARY_INV)
+    return binary_image
+
+
+def _locate_regions(gray):
+    """
+    Find the table and the date box on a downscaled copy of the image.
+
+    Returns:
+        tuple: (x, y, w, h) rects of the table and the date box in full resolution, padded
+        so that the regions are fully inside them
+    """
+    height, width = gray.shape
+    # Any image wider than COARSE_WIDTH is downscaled, also by a fractional factor
+    scale = min(1.0, COARSE_WIDTH / width)
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+
+    # Detect external contours only
+    external_contours, _ = cv2.findContours(_binarize(small), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    external_contours = [c for c in external_contours if cv2.contourArea(c) > 200 * scale * scale]
+
+    # The table is the biggest contour, the date box is the rightmost one above it
+    table_rect = cv2.boundingRect(max(external_contours, key=cv2.contourArea))
+    external_contours_above_table = [c for c in external_contours if cv2.boundingRect(c)[1] < table_rect[1]]
+    date_time_box_rect = cv2.boundingRect(max(external_contours_above_table, key=lambda c: cv2.boundingRect(c)[0]))
+
+    def to_full_resolution(rect):
+        x, y, w, h = rect
+        x0 = max(int((x - COARSE_MARGIN) / scale), 0)
+        y0 = max(int((y - COARSE_MARGIN) / scale), 0)
+        x1 = min(ceil((x + w + COARSE_MARGIN) / scale), width)
+        y1 = min(ceil((y + h + COARSE_MARGIN) / scale), height)
+        return x0, y0, x1 - x0, y1 - y0
+
+    return to_full_resolution(table_rect), to_full_resolution(date_time_box_rect)
+
+
 def recognize(image_path):
     image = cv2.imread(image_path)
 
-    # Preprocess the image: Convert to grayscale and threshold
+    # Preprocess the image: Convert to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    _, binary_image = cv2.threshold(gray, 250, 255, cv2.THRESH_BINARY_INV)
 
-    # Detect external contours only
-    external_contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    external_contours = [c for c in external_contours if cv2.contourArea(c) > 200]
+    # Locate the regions on a small copy, then work at full resolution only inside them
+    table_region, date_time_box_region = _locate_regions(gray)
+
+    # Fit the date box exactly within its region
+    x, y, w, h = date_time_box_region
+    box_contours, _ = cv2.findContours(_binarize(gray[y:y + h, x:x + w]), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    box_x, box_y, box_w, box_h = cv2.boundingRect(max(box_contours, key=cv2.contourArea))
+
+    # Extract the portion of the image denoted by the date box
+    date_time_box_image = image[y + box_y:y + box_y + box_h, x + box_x:x + box_x + box_w]
+
+    # Recognize the text inside the extracted portion, Tesseract is used only for unfamiliar glyphs
+    date_time_text = read_date_time(date_time_box_image)
+
+    # Threshold the table region, cells are located in its coordinates
+    x, y, w, h = table_region
+    binary_image = _binarize(gray[y:y + h, x:x + w])
 
     # Detect all contours
     contours, hierarchy = cv2.findContours(binary_image, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
@@ -34,19 +91,6 @@ def recognize(image_path):
 
     # Find the biggest contour by its area
     id_to_table_contour = max(id_to_filtered_contours, key=lambda c: cv2.contourArea(c[1]))
-    table_contour = id_to_table_contour[1]
-
-    _, table_y, _, _ = cv2.boundingRect(table_contour)
-    external_contours_above_table = [c for c in external_contours if cv2.boundingRect(c)[1] < table_y]
-    external_contours_above_table = sorted(external_contours_above_table, key=lambda c: cv2.boundingRect(c)[0], reverse=True)
-    date_time_box_contour = external_contours_above_table[0]
-
-    # Extract the portion of the image denoted by date_time_box_contour
-    x, y, w, h = cv2.boundingRect(date_time_box_contour)
-    date_time_box_image = image[y:y + h, x:x + w]
-
-    # Recognize the text inside the extracted portion using pytesseract
-    date_time_text = pytesseract.image_to_string(date_time_box_image, config='--psm 6').strip()
 
     # Find internal contours
     id_to_internal_contours = [(i, contours[i]) for i in range(0, hierarchy.shape[1]) if hierarchy[0, i][3] == id_to_table_contour[0]]
@@ -100,11 +144,10 @@ def recognize(image_path):
             cell_x = col_x_coords[col]
             cell_y = col_y_coords[row]
             rect = binary_image[cell_y:cell_y + cell_h, cell_x:cell_x + cell_w]
-            avg_color = np.median(rect)
             blackout_group = f"{row // 2 + 1}.{row % 2 + 1}"
 
-            # Determine if the average color is white
-            is_white = avg_color > 240
+            # Determine if the median color is white: more than half of the binary cell is white
+            is_white = 2 * cv2.countNonZero(rect) > rect.size
 
             if is_white:
                 if start_time is None:
@@ -0,0 +1,260 @@
+"""Reminders sent to subscribers shortly before a blackout starts or ends."""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from datetime import datetime, time as dt_time, timedelta
+from zoneinfo import ZoneInfo
+from telegram.error import NetworkError, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from archive import slot_masks
+from config import config
+from json_converter import load_converted_schedule
+from outbox import backoff_delay, retry_after_seconds
+from schedule_model import SLOTS_PER_DAY
+from sharding import owns_chat
+from subscribers import open_subscriber_store
+import tg
+
+logger = logging.getLogger(__name__)
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+DEFAULT_LEAD_MINUTES = [int(lead) for lead in (os.getenv('REMINDER_LEAD_MINUTES') or '30').split(',')]
+SEND_ATTEMPTS = 3
+
+EVENT_TEXTS = {
+    'start': '⚠️ {group} група: відключення о {time} (через {lead} хв)',
+    'end': '💡 {group} група: світло має з\'явитися о {time} (через {lead} хв)',
+}
+
+
+def _slot_time(schedule_date, slot):
+    if slot == SLOTS_PER_DAY:
+        return datetime.combine(schedule_date + timedelta(days=1), dt_time(0, 0), tzinfo=KYIV_TZ)
+    return datetime.combine(schedule_date, dt_time(slot // 2, 30 * (slot % 2)), tzinfo=KYIV_TZ)
+
+
+def mask_events(schedule_date, mask, previous_day_mask=None):
+    """
+    Blackout starts and ends in a 48-slot mask.
+
+    An outage running over midnight is not reported as a start at 00:00 when the
+    previous day's mask is known to end with an outage.
+
+    Returns:
+        list: (datetime, 'start' or 'end') tuples
+    """
+    events = []
+    previous = bool(previous_day_mask and previous_day_mask >> (SLOTS_PER_DAY - 1) & 1)
+    for slot in range(SLOTS_PER_DAY):
+        current = bool(mask >> slot & 1)
+        if current != previous:
+            events.append((_slot_time(schedule_date, slot), 'start' if current else 'end'))
+        previous = current
+    return events
+
+
+class ReminderScheduler:
+    """
+    Min-heap of pending reminder timers keyed by (date, group, event time, event, lead).
+
+    Re-planning a date only touches groups whose mask changed: their old timers are
+    invalidated by bumping a per-group generation and skipped lazily when popped.
+    """
+
+    def __init__(self, leads):
+        self.leads = sorted(set(leads))
+        self._heap = []
+        self._sequence = itertools.count()
+        # (date, group) -> (mask, generation)
+        self._plans = {}
+        # (date, group) -> number of timers pushed for the current generation
+        self._timer_counts = {}
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._heap) - self._stale
+
+    def plan(self, schedule_date, masks, now=None):
+        """
+        Add timers for the groups whose mask changed for the date.
+
+        The next day of a group is re-planned too when the last slot of the date changed, as
+        that decides whether an outage at its midnight starts or continues.
+
+        Returns:
+            int: Number of groups re-planned
+        """
+        now = now or datetime.now(KYIV_TZ)
+        replanned = 0
+        for group, mask in masks.items():
+            planned = self._plans.get((schedule_date, group))
+            if planned and planned[0] == mask:
+                continue
+            self._plan_group(schedule_date, group, mask, now)
+            replanned += 1
+            last_slot = 1 << (SLOTS_PER_DAY - 1)
+            next_day = self._plans.get((schedule_date + timedelta(days=1), group))
+            if next_day and (planned[0] if planned else 0) & last_slot != mask & last_slot:
+                self._plan_group(schedule_date + timedelta(days=1), group, next_day[0], now)
+        self._compact()
+        return replanned
+
+    def _plan_group(self, schedule_date, group, mask, now):
+        key = (schedule_date, group)
+        planned = self._plans.get(key)
+        generation = planned[1] + 1 if planned else 0
+        self._stale += self._timer_counts.get(key, 0)
+        self._timer_counts[key] = 0
+        self._plans[key] = (mask, generation)
+        previous_day = self._plans.get((schedule_date - timedelta(days=1), group))
+        for event_time, event in mask_events(schedule_date, mask, previous_day[0] if previous_day else None):
+            for lead in self.leads:
+                fire_time = event_time - timedelta(minutes=lead)
+                if fire_time <= now:
+                    continue
+                reminder = (schedule_date, group, event_time, event, lead)
+                heapq.heappush(self._heap, (fire_time.timestamp(), next(self._sequence), reminder, generation))
+                self._timer_counts[key] += 1
+
+    def forget_before(self, schedule_date):
+        for key in [key for key in self._plans if key[0] < schedule_date]:
+            del self._plans[key]
+            self._stale += self._timer_counts.pop(key, 0)
+        self._compact()
+
+    def _compact(self):
+        if self._stale > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def _is_current(self, entry):
+        schedule_date, group = entry[2][:2]
+        planned = self._plans.get((schedule_date, group))
+        return planned is not None and planned[1] == entry[3]
+
+    def next_fire_time(self):
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+            self._stale = max(self._stale - 1, 0)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now_timestamp):
+        """Remove and return the reminders whose time has come."""
+        due = []
+        while self._heap and self._heap[0][0] <= now_timestamp:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                self._timer_counts[entry[2][:2]] -= 1
+                due.append(entry[2])
+            else:
+                self._stale = max(self._stale - 1, 0)
+        return due
+
+
+def _send(chat_id, message_text):
+    # Flood control waits are not failures, only network errors use up the attempts
+    attempt = 0
+    while attempt < SEND_ATTEMPTS:
+        try:
+            tg.send_text_message(chat_id, message_text)
+            return True
+        except RetryAfter as e:
+            time.sleep(retry_after_seconds(e))
+        except NetworkError as e:
+            logger.warning(f"Failed to send reminder to chat {chat_id}: {e}")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+        except TelegramError as e:
+            logger.error(f"Reminder to chat {chat_id} rejected: {e}")
+            return False
+    return False
+
+
+def fire_reminders(reminders):
+    """Send the reminders to the chats subscribed to their groups."""
+    with open_subscriber_store() as store:
+        for _, group, event_time, event, lead in reminders:
+            chats = [chat_id for chat_id in store.chats_for_groups([group]) if owns_chat(chat_id)]
+            logger.info(f"Reminder: {event} of group {group} at {event_time:%H:%M}, {len(chats)} chats")
+            message_text = escape_markdown(
+                EVENT_TEXTS[event].format(group=group, time=event_time.strftime('%H:%M'), lead=lead), version=2)
+            for chat_id in chats:
+                _send(chat_id, message_text)
+
+
+class ScheduleWatcher:
+    """Feeds the scheduler with the schedules that meta_info.json points to."""
+
+    def __init__(self, out_dir, scheduler):
+        self.out_dir = out_dir
+        self.scheduler = scheduler
+        self.meta_mtime = None
+        self.loaded_files = {}
+
+    def refresh(self):
+        meta_file_path = os.path.join(self.out_dir, 'meta_info.json')
+        try:
+            meta_mtime = os.path.getmtime(meta_file_path)
+        except FileNotFoundError:
+            return
+        if meta_mtime == self.meta_mtime:
+            return
+        self.meta_mtime = meta_mtime
+        with open(meta_file_path, 'r') as f:
+            meta_info = json.load(f)
+        today = datetime.now(KYIV_TZ).date()
+        self.scheduler.forget_before(today - timedelta(days=1))
+        # Oldest date first so that outages running over midnight are recognized
+        for date_str, file_name in sorted(meta_info.items(), key=lambda item: datetime.strptime(item[0], "%d.%m.%Y")):
+            schedule_date = datetime.strptime(date_str, "%d.%m.%Y").date()
+            if schedule_date < today - timedelta(days=1) or self.loaded_files.get(date_str) == file_name:
+                continue
+            try:
+                schedule = load_converted_schedule(os.path.join(self.out_dir, file_name))
+            except FileNotFoundError:
+                logger.warning(f"Schedule file is missing: {file_name}")
+                continue
+            replanned = self.scheduler.plan(schedule_date, slot_masks(schedule))
+            self.loaded_files[date_str] = file_name
+            logger.info(f"Planned reminders for {date_str}: {replanned} groups changed, {len(self.scheduler)} timers pending")
+
+
+def run(out_dir, leads, reload_interval):
+    scheduler = ReminderScheduler(leads)
+    watcher = ScheduleWatcher(out_dir, scheduler)
+    while True:
+        watcher.refresh()
+        due = scheduler.pop_due(time.time())
+        if due:
+            fire_reminders(due)
+            continue
+        next_fire_time = scheduler.next_fire_time()
+        sleep_seconds = reload_interval if next_fire_time is None else min(reload_interval, next_fire_time - time.time())
+        time.sleep(max(sleep_seconds, 0))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Send reminders before scheduled blackouts.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Directory with the converted schedules')
+    parser.add_argument('--lead', type=int, action='append',
+                        help='Minutes before a blackout starts or ends to remind, can be repeated')
+    parser.add_argument('--reload_interval', type=float, default=30,
+                        help='Seconds between checks of meta_info.json for new schedules')
+    parser.add_argument('--shard_index', type=int, default=int(os.getenv('SHARD_INDEX') or 0))
+    parser.add_argument('--shard_count', type=int, default=int(os.getenv('SHARD_COUNT') or 1))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    config.initialize(None, None, args.out_dir, None, 'reminders', args.shard_index, args.shard_count)
+    run(args.out_dir, args.lead or DEFAULT_LEAD_MINUTES, args.reload_interval)
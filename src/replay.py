@@ -0,0 +1,192 @@
+"""Replay of archived supplier JSON files through the conversion and dispatch pipeline."""
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from config import config
+from json_converter import convert_supplier_json_to_internal
+from main import process_supplier_json
+from outbox import drain_outbox
+from subscribers import open_subscriber_store
+import schedule_handler
+import tg
+
+logger = logging.getLogger(__name__)
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+
+class _StubMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class StubBot:
+    """Stands in for telegram.Bot: every call succeeds instantly and is counted."""
+
+    calls = Counter()
+    _message_ids = iter(range(1, 2 ** 31))
+
+    def __init__(self, token=None):
+        pass
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            StubBot.calls[name] += 1
+            if name == 'send_media_group':
+                return tuple(_StubMessage(next(StubBot._message_ids)) for _ in kwargs['media'])
+            return _StubMessage(next(StubBot._message_ids))
+        return call
+
+
+def _published_at(file_path):
+    """Publication time of a supplier file: its update time, or the start of its first day."""
+    with open(file_path, 'r') as f:
+        supplier_data = json.load(f)
+    try:
+        return datetime.strptime(supplier_data.get("update", ""), "%d.%m.%Y %H:%M").replace(tzinfo=KYIV_TZ)
+    except ValueError:
+        return datetime.fromtimestamp(supplier_data.get("today", 0), tz=KYIV_TZ)
+
+
+def _replay_order(file_path):
+    """Files are replayed in the order the supplier published them."""
+    with open(file_path, 'r') as f:
+        today = json.load(f).get("today", 0)
+    return _published_at(file_path), today, os.path.getmtime(file_path), os.path.basename(file_path)
+
+
+def _default_subscriptions(input_files):
+    """One chat per group found in the files, so that every change reaches the handler."""
+    groups = set()
+    for file_path in input_files:
+        for schedule in convert_supplier_json_to_internal(file_path):
+            groups |= schedule.groups
+    return {str(chat_id): [group] for chat_id, group in enumerate(sorted(groups), start=1)}
+
+
+def _verify(out_dir, file_name, expected_dir):
+    expected_path = os.path.join(expected_dir, file_name)
+    if not os.path.exists(expected_path):
+        return 'missing'
+    with open(os.path.join(out_dir, file_name), 'rb') as produced, open(expected_path, 'rb') as expected:
+        return 'match' if produced.read() == expected.read() else 'mismatch'
+
+
+def replay(input_files, work_dir, expected_dir, subscriptions):
+    """
+    Process the supplier files one by one, as the downloader would, with Telegram stubbed.
+
+    Args:
+        input_files: Supplier JSON files in replay order
+        work_dir: Empty directory for the input copies, out_dir and group_log of the replay
+        expected_dir: Directory with the stored converted schedules to compare with
+        subscriptions: Mapping of chat_id -> groups
+
+    Returns:
+        dict: Replay statistics, "per_file" lists (file name, latency in ms, output check) in replay order
+    """
+    input_dir = os.path.join(work_dir, 'input')
+    out_dir = os.path.join(work_dir, 'out')
+    group_log = os.path.join(work_dir, 'group-logs')
+    for directory in (input_dir, out_dir, group_log):
+        os.makedirs(directory, exist_ok=True)
+    config.initialize(input_dir, None, out_dir, group_log, 'json')
+    tg.Bot = StubBot
+    # Keep the replay away from the production registry
+    os.environ['SUBSCRIBERS_DB'] = os.path.join(out_dir, 'subscribers.sqlite3')
+    with open_subscriber_store() as store:
+        store.import_mapping(subscriptions, replace=True)
+
+    latencies = []
+    per_file = []
+    verification = Counter()
+    schedules_count = 0
+    unchanged_files = 0
+    started_at = time.perf_counter()
+    for file_path in input_files:
+        src = os.path.join(input_dir, os.path.basename(file_path))
+        shutil.copyfile(file_path, src)
+        config.src = src
+        # Historical schedules are handled as on the day they were published
+        published_at = _published_at(file_path)
+        schedule_handler._now = lambda: published_at
+        file_started_at = time.perf_counter()
+        saved_schedules, changed = process_supplier_json(src, out_dir, group_log)
+        drain_outbox()
+        latency = time.perf_counter() - file_started_at
+        latencies.append(latency)
+        unchanged_files += not changed
+        schedules_count += len(saved_schedules)
+        file_result = 'match'
+        for _, file_name in saved_schedules:
+            result = _verify(out_dir, file_name, expected_dir)
+            if result != 'match':
+                logger.warning(f"{os.path.basename(file_path)}: {file_name} is {result} in {expected_dir}")
+                file_result = result
+            verification[result] += 1
+        per_file.append((os.path.basename(file_path), latency * 1000, file_result))
+    total_seconds = time.perf_counter() - started_at
+
+    return {
+        "files": len(input_files),
+        "schedules": schedules_count,
+        "unchanged_files": unchanged_files,
+        "total_seconds": total_seconds,
+        "files_per_second": len(input_files) / total_seconds if total_seconds else 0,
+        "latency_ms": {
+            "min": min(latencies) * 1000,
+            "median": statistics.median(latencies) * 1000,
+            "p95": sorted(latencies)[math.ceil(0.95 * len(latencies)) - 1] * 1000,
+            "max": max(latencies) * 1000,
+        } if latencies else {},
+        "outputs": dict(verification),
+        "telegram_calls": dict(StubBot.calls),
+        "per_file": per_file,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay archived supplier JSON files with Telegram stubbed.')
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory with supplier JSON files')
+    parser.add_argument('--expected_dir', type=str, required=True,
+                        help='Directory with the stored converted schedules, e.g. output/')
+    parser.add_argument('--subscribers', type=str,
+                        help='JSON file in the CHAT_ID_TO_BLACKOUT_GROUPS format, one chat per group by default')
+    parser.add_argument('--work_dir', type=str, help='Directory for the replay files, a temporary one by default')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    input_files = sorted(glob.glob(os.path.join(args.input_dir, '*.json')), key=_replay_order)
+    if args.subscribers:
+        with open(args.subscribers, 'r') as f:
+            subscriptions = json.load(f)
+    else:
+        subscriptions = _default_subscriptions(input_files)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bsn-replay-')
+    try:
+        stats = replay(input_files, work_dir, args.expected_dir, subscriptions)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for file_name, latency_ms, result in stats.pop("per_file"):
+        print(f"{file_name}  {latency_ms:9.1f} ms  {result}")
+    print(json.dumps(stats, indent=2))
+    if stats["outputs"].get('mismatch') or stats["outputs"].get('missing'):
+        exit(1)
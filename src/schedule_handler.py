@@ -1,10 +1,14 @@
 import hashlib
 import logging
+from collections import defaultdict, namedtuple
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 import os
 import json
-from tg import post_message_with_image
-from image_generator import generate_schedule_table_image
+from outbox import enqueue_delivery, mark_delivered
+from sharding import owns_chat, shard_name
+from subscribers import open_subscriber_store
+from image_generator import schedule_table_png
 from zoneinfo import ZoneInfo
 from telegram.helpers import escape_markdown
 
@@ -13,8 +17,8 @@ logger = logging.getLogger(__name__)
 # Europe/Kyiv timezone
 KYIV_TZ = ZoneInfo("Europe/Kyiv")
 
-CHAT_ID_TO_BLACKOUT_GROUPS = json.loads(
-    os.getenv('CHAT_ID_TO_BLACKOUT_GROUPS') or '{}')
+# Keep a copy of every table sent next to the input file, tables are uploaded from memory either way
+SAVE_TABLE_IMAGES = (os.getenv('SAVE_TABLE_IMAGES') or '').lower() in ('1', 'true', 'yes')
 
 def generate_markdown(date_time, groups, blackouts, last_updated_str):
     message = f"""
@@ -32,114 +36,310 @@ def time_converter(obj):
     raise TypeError("Type not serializable")
 
 
-def _store_hash_if_not_exist(directory, json_data, chat_id):
-    json_str = json.dumps(json_data, sort_keys=True, default=time_converter)
+def group_digests(schedule):
+    return {group: hashlib.md5(schedule.periods_json(group).encode()).hexdigest() for group in schedule.groups}
+
+
+def _affected_chats(schedule, only_groups=None, held_groups=(), store=None):
+    """
+    Find the chats of this shard that may need an update: chats subscribed to a group whose
+    schedule changed since the last dispatch of the date, and chats whose subscription changed.
+    With only_groups, changes of other groups are left for a later dispatch.
+
+    Chats subscribed to one of held_groups are left out, so that they never get a version of
+    a group that is still changing. The changes of their other groups are not recorded as
+    dispatched either, they reach these chats with a later dispatch.
+
+    store is the registry to read, opened for the call by default.
+
+    Returns:
+        tuple: (dict of chat_id -> groups, callback recording the dispatch once it is done,
+            set of changed groups left for a later dispatch)
+    """
+    scope = shard_name()
+    schedule_date = schedule.date_time
+    digests = group_digests(schedule)
+    if only_groups is not None:
+        digests = {group: digest for group, digest in digests.items() if group in only_groups}
+    dispatch_started_at = datetime.now().timestamp()
+    with (nullcontext(store) if store is not None else open_subscriber_store()) as store:
+        changed_groups = store.changed_groups(scope, schedule_date, digests)
+        last_dispatched_at = store.last_dispatched_at(scope, schedule_date)
+        chats = store.chats_for_groups(changed_groups, updated_since=last_dispatched_at)
+    logger.info(f"Changed groups for {schedule_date}: {sorted(changed_groups)}, chats to check: {len(chats)}")
+
+    chats = {chat_id: groups for chat_id, groups in chats.items() if owns_chat(chat_id)}
+    held_chats = {chat_id: groups for chat_id, groups in chats.items() if set(groups) & set(held_groups)}
+    deferred_groups = {group for groups in held_chats.values() for group in groups if group in changed_groups}
+    if held_chats:
+        logger.info(f"Holding {len(held_chats)} chats until {sorted(held_groups)} settle, deferring {sorted(deferred_groups)}")
+    dispatched_digests = {group: digest for group, digest in digests.items() if group not in deferred_groups}
+
+    def record_dispatch():
+        with open_subscriber_store() as store:
+            store.record_dispatch(scope, schedule_date, dispatched_digests, dispatch_started_at)
+
+    chats = {chat_id: groups for chat_id, groups in chats.items() if chat_id not in held_chats}
+    return chats, record_dispatch, deferred_groups
+
+
+def _change_hash_path(directory, json_str, chat_id):
     md5_hash = hashlib.md5(json_str.encode() + chat_id.encode()).hexdigest()
-    file_path = os.path.join(directory, f"{md5_hash}")
-    hash_file_exists = os.path.exists(file_path)
+    return os.path.join(directory, f"{md5_hash}")
+
+
+def _is_new_change(file_path):
+    """
+    Check whether the chat has not received this change yet.
 
-    if hash_file_exists:
+    The hash file itself is written by the outbox once the delivery succeeds.
+    Already known hashes are touched so that cleanup keeps them while they stay current.
+    """
+    if os.path.exists(file_path):
         logger.info(f"File already exists: {file_path}")
+        with open(file_path, 'w') as f:
+            f.write(str(int(datetime.now().timestamp())))
+        return False
+    return True
+
+
+def _table_image_path(image_path, groups):
+    table_image_path = image_path.replace('.json', '_table.png').replace('.jpg', '_table.png').replace('.png', '_table.png')
+    # Chats with different groups get different tables, so each set of groups needs its own file
+    base, ext = os.path.splitext(table_image_path)
+    return f"{base}_{'_'.join(groups)}{ext}"
+
+
+def _now():
+    return datetime.now(KYIV_TZ)
+
+
+class UpdateBatch:
+    """
+    Updates prepared for the chats over all dates handled in one run. Every chat gets its
+    updates in a single delivery, an album when several dates changed.
+
+    With a DispatchPipeline, tables are rendered in its process pool and the deliveries are sent
+    as soon as their tables are ready. Without it, tables are rendered inline and the deliveries
+    are left in the outbox for drain_outbox.
+    """
+
+    def __init__(self, pipeline=None):
+        self.pipeline = pipeline
+        self._updates = defaultdict(list)
+        self._on_sent = []
+
+    def render(self, schedule, archive_path, groups):
+        if self.pipeline is None:
+            return schedule_table_png(schedule, groups, archive_path)
+        return self.pipeline.render(schedule, archive_path, groups)
+
+    def add(self, chat_id, table_image, message, schedule_date_time, change_hash_path, table=None):
+        self._updates[chat_id].append((table_image, message, schedule_date_time, change_hash_path, table))
+
+    def on_sent(self, callback):
+        self._on_sent.append(callback)
+
+    def send(self):
+        """
+        Queue one delivery per chat, then run the callbacks of the handled dates.
+
+        The callbacks run only once every delivery was sent or stored in the outbox for a retry.
+        Otherwise the dispatch is not recorded, and the next run plans the same changes again.
+
+        Returns:
+            bool: Whether the callbacks were run
+        """
+        deliveries = []
+        for chat_id, updates in self._updates.items():
+            updates.sort(key=lambda update: update[2])
+            if self.pipeline is None:
+                enqueue_delivery(chat_id, updates)
+            else:
+                deliveries.append((chat_id, self.pipeline.deliver(chat_id, updates)))
+        self._updates.clear()
+
+        undelivered = []
+        for chat_id, delivery in deliveries:
+            if delivery.exception() is not None or delivery.result() not in ('sent', 'deferred'):
+                undelivered.append(chat_id)
+        callbacks, self._on_sent = self._on_sent, []
+        if undelivered:
+            logger.warning(f"Not recording the dispatch, updates for chats {undelivered} were not delivered")
+            return False
+        for callback in callbacks:
+            callback()
+        return True
+
+
+# An update a chat needs: its groups and the change hash file recorded once it is delivered
+PlannedUpdate = namedtuple('PlannedUpdate', ['chat_id', 'groups', 'change_hash_path'])
+
 
-    with open(file_path, 'w') as f:
-        f.write(str(int(datetime.now().timestamp())))
-    
-    return not hash_file_exists
+def _schedule_date_time(schedule):
+    return schedule.slot_time(0)
 
 
-def handle_schedule_change(schedule, image_path, group_log):
-    now_kyiv = datetime.now(KYIV_TZ)
-    schedule_date_time = datetime.strptime(schedule["date_time"], "%d.%m.%Y").replace(tzinfo=KYIV_TZ, hour=0, minute=0, second=0, microsecond=0)
-    if now_kyiv.date() > schedule_date_time.date():
+def _time_line(schedule, groups):
+    time_line = []
+    for group in groups:
+        for blackout in schedule.blackouts.get(group, []):
+            time_line.append((blackout['start'], group, 'start'))
+            time_line.append((blackout['end'], group, 'end'))
+    time_line.sort(key=lambda x: x[0])
+    return time_line
+
+
+def plan_schedule_change(schedule, group_log, only_groups=None, dry_run=False, held_groups=(), store=None):
+    """
+    Decide which chats need an update for a new schedule version, without building any message.
+
+    A chat needs an update when the part of the schedule its message is made of has changed since
+    the chat last received one.
+
+    Args:
+        schedule: Converted schedule of one date
+        group_log: Directory for tracking group schedule changes
+        only_groups: Consider only changes of these groups
+        dry_run: Leave the change hash files untouched
+        held_groups: Groups still changing, chats subscribed to them are left for later
+        store: Subscriber registry to plan with, e.g. a snapshot for a dry run
+
+    Returns:
+        tuple: (list of PlannedUpdate, callback recording the dispatch once the updates are queued,
+            set of changed groups left for a later dispatch)
+    """
+    if _now().date() > _schedule_date_time(schedule).date():
         logger.info("Schedule date is in the past. Skipping.")
-        return
-    for chat_id, groups in CHAT_ID_TO_BLACKOUT_GROUPS.items():
-        logger.info(
-            f"Handling schedule change for chat_id: {chat_id} and groups: {groups}")
-        table_image_path = image_path.replace('.json', '_table.png').replace('.jpg', '_table.png').replace('.png', '_table.png')
-        table_image_path = generate_schedule_table_image(schedule, table_image_path, groups)
+        return [], lambda: None, set()
+    chats, record_dispatch, deferred_groups = _affected_chats(schedule, only_groups, held_groups, store)
+    plan = []
+    for chat_id, groups in chats.items():
         if len(groups) == 1:
-            logger.info("Handling single group")
-            date_time = schedule["date_time"]
-            group_schedule = schedule["blackouts"][groups[0]]
-            if not _store_hash_if_not_exist(group_log, group_schedule, chat_id):
-                logger.info("No changes in the schedule for the group")
-                continue
-            schedule_text_block = '\n'.join(
-                [escape_markdown(f"◾️ {item['start'].strftime('%H:%M')} - {item['end'].strftime('%H:%M')}", version=2) for item in group_schedule])
-            message = generate_markdown(
-                date_time, groups, schedule_text_block, schedule.get("last_updated"))
-            logger.info(
-                f"Posting message with image: {table_image_path} and message: {message}")
-            post_message_with_image(chat_id, table_image_path, message, schedule_date_time)
+            change_hash_path = _change_hash_path(group_log, schedule.periods_json(groups[0]), chat_id)
         else:
-            logger.info("Handling multiple groups")
-            date_time = schedule["date_time"]
-            time_line = []
-            for group in groups:
-                if group in schedule["blackouts"]:
-                    for blackout in schedule["blackouts"][group]:
-                        time_line.append((blackout['start'], group, 'start'))
-                        time_line.append((blackout['end'], group, 'end'))
-            
-            time_line.sort(key=lambda x: x[0])
-            num_groups = len(groups)
-            merged_schedule = []
-            stack = []
-            possible_switches = []
-
-            if not _store_hash_if_not_exist(group_log, time_line, chat_id):
-                logger.info(
-                    f"No changes in the schedule for the groups {groups}")
-                continue
-            for time_point, group, event in time_line:
-                if event == 'start':
-                    last_start_time = stack[-1][0] if len(stack) > 0 else None
-                    stack.append((time_point, group))
-                    if last_start_time and time_point > last_start_time:
-                        possible_switches.append(
-                            {'start': time_point, 'end': time_point + timedelta(minutes=30)})
+            time_line_json = json.dumps(_time_line(schedule, groups), sort_keys=True, default=time_converter)
+            change_hash_path = _change_hash_path(group_log, time_line_json, chat_id)
+        is_new = not os.path.exists(change_hash_path) if dry_run else _is_new_change(change_hash_path)
+        if not is_new:
+            logger.info(f"No changes in the schedule for chat_id: {chat_id} and groups: {groups}")
+            continue
+        plan.append(PlannedUpdate(chat_id, groups, change_hash_path))
+    logger.info(f"Planned updates for {schedule.date_time}: {len(plan)} of {len(chats)} chats")
+    return plan, record_dispatch, deferred_groups
+
+
+def build_message(schedule, groups, now_kyiv):
+    """
+    Markdown message with the schedule of the groups.
+
+    Returns:
+        str: The message, None if there is nothing to tell about a future date
+    """
+    date_time = schedule.date_time
+    schedule_date_time = _schedule_date_time(schedule)
+    if len(groups) == 1:
+        logger.info("Handling single group")
+        schedule_text_block = '\n'.join(
+            [escape_markdown(f"◾️ {period}", version=2) for period in schedule.period_texts(groups[0])])
+        return generate_markdown(
+            date_time, groups, schedule_text_block, schedule.last_updated)
+
+    logger.info("Handling multiple groups")
+    time_line = _time_line(schedule, groups)
+    num_groups = len(groups)
+    merged_schedule = []
+    stack = []
+    possible_switches = []
+
+    for time_point, group, event in time_line:
+        if event == 'start':
+            last_start_time = stack[-1][0] if len(stack) > 0 else None
+            stack.append((time_point, group))
+            if last_start_time and time_point > last_start_time:
+                possible_switches.append(
+                    {'start': time_point, 'end': time_point + timedelta(minutes=30)})
+        else:
+            start_time, _ = stack.pop()
+            if len(stack) == num_groups - 1:
+                if start_time != time_point:
+                    merged_schedule.append(
+                        {'start': start_time, 'end': time_point})
                 else:
-                    start_time, _ = stack.pop()
-                    if len(stack) == num_groups - 1:
-                        if start_time != time_point:
-                            merged_schedule.append(
-                                {'start': start_time, 'end': time_point})
-                        else:
-                            possible_switches.append(
-                                {'start': time_point, 'end': time_point + timedelta(minutes=30)})
-
-            if not possible_switches and time_line:
-                first_time = time_line[0][0]
-                last_time = time_line[-1][0]
-                if first_time > datetime.combine(schedule_date_time.date(), datetime.min.time(), tzinfo=KYIV_TZ):
-                    possible_switches.append(
-                        {'start': datetime.combine(schedule_date_time.date(), datetime.min.time(), tzinfo=KYIV_TZ), 'end': first_time})
-                if last_time < datetime.combine(schedule_date_time.date(), datetime.max.time(), tzinfo=KYIV_TZ):
                     possible_switches.append(
-                        {'start': last_time, 'end': datetime.combine(schedule_date_time.date(), datetime.max.time(), tzinfo=KYIV_TZ)})
-
-            texts = []
-
-            merged_schedule = [
-                 period for period in merged_schedule
-                 if period['end'] > now_kyiv
-            ]
-            if merged_schedule:
-                schedule_text_block = escape_markdown('Відключення:\n', version=2) + \
-                    '\n'.join(
-                        [escape_markdown(f"◾️ {item['start'].strftime('%H:%M')} - {item['end'].strftime('%H:%M')}", version=2) for item in merged_schedule])
-                texts.append(schedule_text_block + '\n')
-            if possible_switches:
-                possible_switches_text_block = '🔀 Можливі перемикання протягом дня\n'
-                texts.append(possible_switches_text_block)
-            if not merged_schedule and not possible_switches:
-                if schedule_date_time.date() == datetime.now(KYIV_TZ).date():
-                    texts.append(escape_markdown('💡 Відключення не заплановані', version=2))
-                else:
-                    continue
-            message = generate_markdown(
-                date_time, groups, '\n'.join(texts), schedule.get("last_updated"))
-            logger.info(
-                f"Posting message with image: {table_image_path} and message: {message}")
-            post_message_with_image(chat_id, table_image_path, message, schedule_date_time)
+                        {'start': time_point, 'end': time_point + timedelta(minutes=30)})
+
+    if not possible_switches and time_line:
+        first_time = time_line[0][0]
+        last_time = time_line[-1][0]
+        if first_time > datetime.combine(schedule_date_time.date(), datetime.min.time(), tzinfo=KYIV_TZ):
+            possible_switches.append(
+                {'start': datetime.combine(schedule_date_time.date(), datetime.min.time(), tzinfo=KYIV_TZ), 'end': first_time})
+        if last_time < datetime.combine(schedule_date_time.date(), datetime.max.time(), tzinfo=KYIV_TZ):
+            possible_switches.append(
+                {'start': last_time, 'end': datetime.combine(schedule_date_time.date(), datetime.max.time(), tzinfo=KYIV_TZ)})
+
+    texts = []
+
+    merged_schedule = [
+         period for period in merged_schedule
+         if period['end'] > now_kyiv
+    ]
+    if merged_schedule:
+        schedule_text_block = escape_markdown('Відключення:\n', version=2) + \
+            '\n'.join(
+                [escape_markdown(f"◾️ {item['start'].strftime('%H:%M')} - {item['end'].strftime('%H:%M')}", version=2) for item in merged_schedule])
+        texts.append(schedule_text_block + '\n')
+    if possible_switches:
+        possible_switches_text_block = '🔀 Можливі перемикання протягом дня\n'
+        texts.append(possible_switches_text_block)
+    if not merged_schedule and not possible_switches:
+        if schedule_date_time.date() == now_kyiv.date():
+            texts.append(escape_markdown('💡 Відключення не заплановані', version=2))
+        else:
+            return None
+    return generate_markdown(
+        date_time, groups, '\n'.join(texts), schedule.last_updated)
+
+
+def handle_schedule_change(schedule, image_path, group_log, only_groups=None, batch=None, held_groups=(),
+                           schedule_file=None):
+    """
+    Prepare updates for the chats affected by a new schedule version.
+
+    Tables and messages are built only for the chats in the plan. The updates are added to the
+    batch, to be sent together with those of other dates. Without a batch they are queued in
+    the outbox right away.
+
+    schedule_file is the saved schedule in out_dir, a delivery deferred to a later run can
+    render its table again from it.
+
+    Returns:
+        set: Changed groups left for a later dispatch, as some of their chats wait for held_groups
+    """
+    own_batch = batch is None
+    batch = batch or UpdateBatch()
+
+    now_kyiv = _now()
+    schedule_date_time = _schedule_date_time(schedule)
+    plan, record_dispatch, deferred_groups = plan_schedule_change(schedule, group_log, only_groups,
+                                                                  held_groups=held_groups)
+    for chat_id, groups, change_hash_path in plan:
+        logger.info(
+            f"Handling schedule change for chat_id: {chat_id} and groups: {groups}")
+        message = build_message(schedule, groups, now_kyiv)
+        if message is None:
+            # Nothing to tell, the chat is up to date with this version
+            mark_delivered(change_hash_path)
+            continue
+        table_image_path = _table_image_path(image_path, groups) if SAVE_TABLE_IMAGES else None
+        table_image = batch.render(schedule, table_image_path, groups)
+        logger.info(
+            f"Queueing message with image for groups: {groups} and message: {message}")
+        table = {"schedule_file": schedule_file, "groups": groups} if schedule_file else None
+        batch.add(chat_id, table_image, message, schedule_date_time, change_hash_path, table)
+
+    batch.on_sent(record_dispatch)
+    if own_batch:
+        batch.send()
+    return deferred_groups
@@ -0,0 +1,176 @@
+"""Compact schedule of one date: a half-hour blackout mask per group, with views built on demand."""
+import json
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+# Europe/Kyiv timezone
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+SLOTS_PER_DAY = 48
+HOURS_PER_DAY = 24
+
+
+def slot_of(value):
+    """Half-hour slot (0-48) of an interval boundary, a datetime or an "HH:MM" string."""
+    if isinstance(value, str):
+        hour, minute = (int(part) for part in value.split(':'))
+    else:
+        hour, minute = value.hour, value.minute
+    return hour * 2 + (1 if minute >= 30 else 0)
+
+
+def slot_text(slot):
+    """"HH:MM" of a slot boundary, 48 is the midnight at the end of the day."""
+    slot %= SLOTS_PER_DAY
+    return f"{slot // 2:02d}:{30 * (slot % 2):02d}"
+
+
+def mask_runs(mask):
+    """
+    Blackout intervals of a mask.
+
+    Returns:
+        list: (start slot, end slot) tuples, the end slot is exclusive
+    """
+    runs = []
+    slot = 0
+    while mask >> slot:
+        if not mask >> slot & 1:
+            slot += 1
+            continue
+        start = slot
+        while slot < SLOTS_PER_DAY and mask >> slot & 1:
+            slot += 1
+        runs.append((start, slot))
+    return runs
+
+
+class Schedule:
+    """
+    Blackout schedule of one date.
+
+    Bit N of a group mask is set when the group has no power during slot N (00:00-00:30 is
+    slot 0). Intervals, texts and the JSON are derived from the masks when first needed and
+    cached, so a schedule must not be changed once it is in use.
+
+    hour_masks are the 24-hour masks the supplier converter has always saved as "bit_masks",
+    bit N for hour N + 1. They are kept as they are so that saved files stay byte-identical.
+    """
+
+    __slots__ = ('date_time', 'last_updated', 'masks', 'hour_masks', '_blackouts', '_texts', '_json')
+
+    def __init__(self, date_time, masks, hour_masks=None, last_updated=None):
+        """
+        Args:
+            date_time: Date of the schedule, DD.MM.YYYY
+            masks: Mapping of group -> 48-slot blackout mask
+            hour_masks: Mapping of group -> legacy 24-hour mask
+            last_updated: Time the supplier published the schedule, DD.MM.YYYY HH:MM
+        """
+        self.date_time = date_time
+        self.last_updated = last_updated
+        self.masks = masks
+        self.hour_masks = hour_masks or {}
+        self._blackouts = None
+        self._texts = None
+        self._json = None
+
+    @classmethod
+    def from_intervals(cls, date_time, blackouts, hour_masks=None, last_updated=None):
+        """
+        Args:
+            blackouts: Mapping of group -> list of {"start": ..., "end": ...} with datetimes
+                or "HH:MM" strings, an end at 00:00 is the end of the day
+        """
+        masks = {}
+        for group, periods in blackouts.items():
+            mask = 0
+            for period in periods:
+                start_slot = slot_of(period["start"])
+                end_slot = slot_of(period["end"])
+                if end_slot <= start_slot:
+                    end_slot = SLOTS_PER_DAY
+                mask |= (1 << end_slot) - (1 << start_slot)
+            masks[group] = mask
+        return cls(date_time, masks, hour_masks, last_updated)
+
+    @classmethod
+    def from_json(cls, data):
+        """Schedule from the content of a saved schedule file."""
+        hour_masks = {group: int(mask, 2) for group, mask in data.get("bit_masks", {}).items()}
+        return cls.from_intervals(data["date_time"], data["blackouts"], hour_masks, data.get("last_updated"))
+
+    def __getstate__(self):
+        # Worker processes rebuild the views they need
+        return None, {'date_time': self.date_time, 'last_updated': self.last_updated,
+                      'masks': self.masks, 'hour_masks': self.hour_masks,
+                      '_blackouts': None, '_texts': None, '_json': None}
+
+    @property
+    def date(self):
+        return datetime.strptime(self.date_time, "%d.%m.%Y").date()
+
+    @property
+    def groups(self):
+        """Every group the schedule knows about, with or without blackouts."""
+        return set(self.masks) | set(self.hour_masks)
+
+    def mask(self, group):
+        return self.masks.get(group, 0)
+
+    def slot_time(self, slot):
+        """Start of a slot as a datetime, slot 48 is the midnight at the end of the day."""
+        return datetime.combine(self.date, time(0, 0), tzinfo=KYIV_TZ) + timedelta(minutes=30 * slot)
+
+    @property
+    def blackouts(self):
+        """
+        Returns:
+            dict: group -> list of {"start": datetime, "end": datetime}, groups with blackouts only
+        """
+        if self._blackouts is None:
+            self._blackouts = {
+                group: [{"start": self.slot_time(start), "end": self.slot_time(end)} for start, end in mask_runs(mask)]
+                for group, mask in self.masks.items() if mask
+            }
+        return self._blackouts
+
+    def period_texts(self, group):
+        """
+        Returns:
+            list: "HH:MM - HH:MM" of every blackout of the group
+        """
+        if self._texts is None:
+            self._texts = {}
+        if group not in self._texts:
+            self._texts[group] = [f"{slot_text(start)} - {slot_text(end)}" for start, end in mask_runs(self.mask(group))]
+        return self._texts[group]
+
+    def periods_json(self, group):
+        """Blackouts of the group serialized as in the saved schedule file."""
+        return json.dumps(self._periods(group), sort_keys=True)
+
+    def _periods(self, group):
+        return [{"start": slot_text(start), "end": slot_text(end)} for start, end in mask_runs(self.mask(group))]
+
+    def to_dict(self, groups=None):
+        """
+        Content of the saved schedule file, optionally limited to some groups.
+
+        Returns:
+            dict: {"date_time", "blackouts", "bit_masks", "last_updated"} with "HH:MM" times
+        """
+        return {
+            "date_time": self.date_time,
+            "blackouts": {group: self._periods(group) for group, mask in self.masks.items()
+                          if mask and (not groups or group in groups)},
+            "bit_masks": {group: format(mask, f'0{HOURS_PER_DAY}b') for group, mask in self.hour_masks.items()
+                          if not groups or group in groups},
+            "last_updated": self.last_updated,
+        }
+
+    def to_json(self):
+        """Canonical JSON of the schedule, the saved file is named by its MD5."""
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), sort_keys=True)
+        return self._json
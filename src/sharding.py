@@ -0,0 +1,49 @@
+"""Assignment of subscriber chats to notifier instances (shards)."""
+import hashlib
+import os
+from config import config
+
+
+def _chat_weight(chat_id, shard_index):
+    return hashlib.md5(f"{chat_id}:{shard_index}".encode()).digest()
+
+
+def shard_for_chat(chat_id, shard_count):
+    """
+    Pick the shard that serves the chat using rendezvous (highest random weight) hashing.
+
+    The assignment is stable: changing shard_count from N to N + 1 moves only ~1/(N + 1)
+    of the chats, all of them to the new shard.
+    """
+    if shard_count <= 1:
+        return 0
+    return max(range(shard_count), key=lambda shard_index: _chat_weight(chat_id, shard_index))
+
+
+def owns_chat(chat_id):
+    """Check whether the current instance is responsible for the chat."""
+    return shard_for_chat(str(chat_id), config.shard_count) == config.shard_index
+
+
+def is_sharded():
+    return config.shard_count > 1
+
+
+def shard_name():
+    """Namespace of the current instance in shared stores."""
+    return f"shard-{config.shard_index}" if is_sharded() else "default"
+
+
+def shard_dir(directory):
+    """Per-shard subdirectory of a service directory, the directory itself when not sharded."""
+    if not is_sharded():
+        return directory
+    return os.path.join(directory, f"shard-{config.shard_index}")
+
+
+def shard_file_name(file_name):
+    """Per-shard name of a service file, e.g. telegram-meta-v2.shard-1.json."""
+    if not is_sharded():
+        return file_name
+    base, ext = os.path.splitext(file_name)
+    return f"{base}.shard-{config.shard_index}{ext}"
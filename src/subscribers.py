@@ -0,0 +1,275 @@
+"""Persistent registry of chat subscriptions to blackout groups."""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import sys
+import time
+from config import config
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBERS_DB_FILE_NAME = 'subscribers.sqlite3'
+
+# Where a subscription came from: CHAT_ID_TO_BLACKOUT_GROUPS or this module's command line
+SOURCE_ENV = 'env'
+SOURCE_CLI = 'cli'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    source TEXT NOT NULL DEFAULT 'env',
+    PRIMARY KEY (chat_id, grp)
+);
+CREATE INDEX IF NOT EXISTS subscriptions_by_group ON subscriptions (grp, chat_id);
+CREATE INDEX IF NOT EXISTS subscriptions_by_update ON subscriptions (updated_at);
+CREATE TABLE IF NOT EXISTS group_digests (
+    scope TEXT NOT NULL,
+    schedule_date TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (scope, schedule_date, grp)
+);
+CREATE TABLE IF NOT EXISTS dispatches (
+    scope TEXT NOT NULL,
+    schedule_date TEXT NOT NULL,
+    dispatched_at REAL NOT NULL,
+    PRIMARY KEY (scope, schedule_date)
+);
+"""
+
+
+class SubscriberStore:
+    """
+    SQLite-backed subscriber registry.
+
+    Keeps chat -> groups (in the order the chat subscribed to them) and group -> chats indexes,
+    plus the per-group schedule digests already dispatched, so a schedule update only touches
+    the chats whose groups actually changed.
+    """
+
+    def __init__(self, db_path, read_only=False):
+        self.db_path = db_path
+        if read_only:
+            # Dry runs must not create the database or change its schema
+            self.connection = sqlite3.connect(f"{pathlib.Path(db_path).absolute().as_uri()}?mode=ro", uri=True, timeout=30)
+        else:
+            self.connection = sqlite3.connect(db_path, timeout=30)
+            self.connection.executescript(_SCHEMA)
+            self._migrate()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _migrate(self):
+        columns = [name for _, name, *_ in self.connection.execute("PRAGMA table_info(subscriptions)")]
+        if 'source' not in columns:
+            # Registries from before the column were synced with CHAT_ID_TO_BLACKOUT_GROUPS on every run
+            with self.connection:
+                self.connection.execute("ALTER TABLE subscriptions ADD COLUMN source TEXT NOT NULL DEFAULT 'env'")
+
+    def _write_chat_groups(self, chat_id, groups, now, source):
+        self.connection.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+        self.connection.executemany(
+            "INSERT INTO subscriptions (chat_id, grp, position, updated_at, source) VALUES (?, ?, ?, ?, ?)",
+            [(chat_id, group, position, now, source) for position, group in enumerate(groups)])
+
+    def set_chat_groups(self, chat_id, groups):
+        with self.connection:
+            self._write_chat_groups(str(chat_id), list(groups), time.time(), SOURCE_CLI)
+
+    def remove_chat(self, chat_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM subscriptions WHERE chat_id = ?", (str(chat_id),))
+
+    def groups_for_chat(self, chat_id):
+        rows = self.connection.execute(
+            "SELECT grp FROM subscriptions WHERE chat_id = ? ORDER BY position", (str(chat_id),))
+        return [group for group, in rows]
+
+    def all_subscriptions(self):
+        """
+        Returns:
+            dict: chat_id -> list of groups, the same shape as CHAT_ID_TO_BLACKOUT_GROUPS
+        """
+        rows = self.connection.execute("SELECT chat_id, grp FROM subscriptions ORDER BY chat_id, position")
+        return self._group_rows(rows)
+
+    def _chat_sources(self):
+        rows = self.connection.execute("SELECT DISTINCT chat_id, source FROM subscriptions")
+        return {chat_id: source for chat_id, source in rows}
+
+    def import_mapping(self, mapping, replace=False, source=SOURCE_CLI):
+        """
+        Bulk import subscriptions in the CHAT_ID_TO_BLACKOUT_GROUPS format.
+
+        Chats whose groups are unchanged are left untouched. With replace=True, chats of the
+        same source missing from the mapping are unsubscribed. An import from the environment
+        never changes chats managed from the command line.
+
+        Returns:
+            int: Number of chats added or changed
+        """
+        existing = self.all_subscriptions()
+        sources = self._chat_sources()
+        now = time.time()
+        changed = 0
+        with self.connection:
+            for chat_id, groups in mapping.items():
+                chat_id, groups = str(chat_id), list(groups)
+                if source == SOURCE_ENV and sources.get(chat_id) == SOURCE_CLI:
+                    continue
+                if existing.get(chat_id) == groups:
+                    if sources[chat_id] != source:
+                        self.connection.execute("UPDATE subscriptions SET source = ? WHERE chat_id = ?", (source, chat_id))
+                    continue
+                self._write_chat_groups(chat_id, groups, now, source)
+                changed += 1
+            if replace:
+                imported_chats = {str(chat_id) for chat_id in mapping}
+                stale_chats = [(chat_id,) for chat_id, chat_source in sources.items()
+                               if chat_source == source and chat_id not in imported_chats]
+                self.connection.executemany("DELETE FROM subscriptions WHERE chat_id = ?", stale_chats)
+                if stale_chats:
+                    logger.info(f"Unsubscribed {len(stale_chats)} chats no longer in the {source} subscriptions")
+        return changed
+
+    def chats_for_groups(self, groups, updated_since=None):
+        """
+        Find chats subscribed to any of the groups, or whose subscription changed after updated_since.
+
+        Returns:
+            dict: chat_id -> all groups of the chat, in subscription order
+        """
+        groups = list(groups)
+        conditions = []
+        params = []
+        if groups:
+            conditions.append(f"chat_id IN (SELECT chat_id FROM subscriptions WHERE grp IN ({','.join('?' * len(groups))}))")
+            params.extend(groups)
+        if updated_since is not None:
+            conditions.append("chat_id IN (SELECT chat_id FROM subscriptions WHERE updated_at > ?)")
+            params.append(updated_since)
+        if not conditions:
+            return {}
+        rows = self.connection.execute(
+            f"SELECT chat_id, grp FROM subscriptions WHERE {' OR '.join(conditions)} ORDER BY chat_id, position",
+            params)
+        return self._group_rows(rows)
+
+    def changed_groups(self, scope, schedule_date, group_digests):
+        """Groups whose digest differs from the one last dispatched for the date."""
+        rows = self.connection.execute(
+            "SELECT grp, digest FROM group_digests WHERE scope = ? AND schedule_date = ?", (scope, schedule_date))
+        dispatched = dict(rows)
+        return {group for group, digest in group_digests.items() if dispatched.get(group) != digest}
+
+    def last_dispatched_at(self, scope, schedule_date):
+        row = self.connection.execute(
+            "SELECT dispatched_at FROM dispatches WHERE scope = ? AND schedule_date = ?",
+            (scope, schedule_date)).fetchone()
+        return row[0] if row else None
+
+    def record_dispatch(self, scope, schedule_date, group_digests, dispatched_at):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO group_digests (scope, schedule_date, grp, digest) VALUES (?, ?, ?, ?)",
+                [(scope, schedule_date, group, digest) for group, digest in group_digests.items()])
+            self.connection.execute(
+                "INSERT OR REPLACE INTO dispatches (scope, schedule_date, dispatched_at) VALUES (?, ?, ?)",
+                (scope, schedule_date, dispatched_at))
+
+    @staticmethod
+    def _group_rows(rows):
+        chat_groups = {}
+        for chat_id, group in rows:
+            chat_groups.setdefault(chat_id, []).append(group)
+        return chat_groups
+
+
+def subscribers_db_path():
+    return os.getenv('SUBSCRIBERS_DB') or os.path.join(config.out_dir, SUBSCRIBERS_DB_FILE_NAME)
+
+
+def open_subscriber_store():
+    return SubscriberStore(subscribers_db_path())
+
+
+def open_subscriber_snapshot():
+    """
+    In-memory copy of the registry for dry runs, changes to it are never saved. The registry
+    is only read, and the copy is empty when there is no registry yet.
+    """
+    snapshot = SubscriberStore(':memory:')
+    db_path = subscribers_db_path()
+    if os.path.exists(db_path):
+        with SubscriberStore(db_path, read_only=True) as store:
+            store.connection.backup(snapshot.connection)
+        snapshot.connection.executescript(_SCHEMA)
+        snapshot._migrate()
+    return snapshot
+
+
+def import_from_env(store):
+    """
+    Sync the chats of CHAT_ID_TO_BLACKOUT_GROUPS into the registry when the variable is set.
+    Chats removed from the variable are unsubscribed, chats added with this module's command
+    line are kept.
+
+    Returns:
+        int: Number of chats whose subscription changed
+    """
+    mapping_json = os.getenv('CHAT_ID_TO_BLACKOUT_GROUPS')
+    if not mapping_json:
+        return 0
+    changed = store.import_mapping(json.loads(mapping_json), replace=True, source=SOURCE_ENV)
+    logger.info(f"Imported subscriptions from CHAT_ID_TO_BLACKOUT_GROUPS: {changed} chats changed")
+    return changed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Manage the subscriber registry.')
+    parser.add_argument('--db', type=str, required=True, help='Path to the subscriber database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='Import subscriptions in the CHAT_ID_TO_BLACKOUT_GROUPS format')
+    import_parser.add_argument('src', type=str, help='JSON file, "-" for stdin')
+    import_parser.add_argument('--replace', action='store_true', help='Unsubscribe chats added with the command line that are missing from the file')
+    add_parser = commands.add_parser('add', help='Set the groups of a chat')
+    add_parser.add_argument('chat_id', type=str)
+    add_parser.add_argument('groups', type=str, nargs='+')
+    remove_parser = commands.add_parser('remove', help='Unsubscribe a chat')
+    remove_parser.add_argument('chat_id', type=str)
+    commands.add_parser('export', help='Print all subscriptions as JSON')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    with SubscriberStore(args.db) as store:
+        if args.command == 'import':
+            if args.src == '-':
+                mapping = json.load(sys.stdin)
+            else:
+                with open(args.src, 'r') as f:
+                    mapping = json.load(f)
+            changed = store.import_mapping(mapping, replace=args.replace)
+            logger.info(f"Imported {len(mapping)} chats, {changed} added or changed")
+        elif args.command == 'add':
+            store.set_chat_groups(args.chat_id, args.groups)
+        elif args.command == 'remove':
+            store.remove_chat(args.chat_id)
+        elif args.command == 'export':
+            print(json.dumps(store.all_subscriptions(), indent=2))
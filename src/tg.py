@@ -1,18 +1,36 @@
 import os
 import json
+import hashlib
 from zoneinfo import ZoneInfo
-from telegram import Bot
+from telegram import Bot, InputMediaPhoto
+from telegram.error import BadRequest
 import asyncio
 from datetime import datetime
 from config import config
+from sharding import shard_file_name
 
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 # Europe/Kyiv timezone
 KYIV_TZ = ZoneInfo("Europe/Kyiv")
 
-def _save_message_metadata(chat_id, schedule_date_time, message_id):
+MESSAGE_META_FILE_NAME = 'telegram-meta-v2.json'
+
+def _run(coro):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    loop = asyncio.get_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+def _md5(content):
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.md5(content).hexdigest()
+
+def _save_message_metadata(chat_id, schedule_date_time, message_id, kind=None, image_md5=None, caption_md5=None):
     # Path to telegram metadata file
-    meta_file_path = os.path.join(config.out_dir, 'telegram-meta-v2.json')
+    meta_file_path = os.path.join(config.out_dir, shard_file_name(MESSAGE_META_FILE_NAME))
     schedule_date_str = schedule_date_time.strftime("%d.%m.%Y")
     # Read existing metadata or create new dictionary
     if os.path.exists(meta_file_path):
@@ -24,8 +42,14 @@ def _save_message_metadata(chat_id, schedule_date_time, message_id):
     if str(chat_id) not in meta_data:
         meta_data[str(chat_id)] = {}
     
-    # Update with new message ID
-    meta_data[str(chat_id)][schedule_date_str] = str(message_id)
+    # Update with new message ID and fingerprints of what it currently shows,
+    # so the next update can tell a caption-only change from a new image
+    meta_data[str(chat_id)][schedule_date_str] = {
+        "message_id": str(message_id),
+        "kind": kind,
+        "image_md5": image_md5,
+        "caption_md5": caption_md5,
+    }
 
     if len(meta_data[str(chat_id)].keys()) > 3:
         # Keep only the latest 3 entries
@@ -37,8 +61,8 @@ def _save_message_metadata(chat_id, schedule_date_time, message_id):
     with open(meta_file_path, 'w') as f:
         json.dump(meta_data, f, indent=2)
 
-def _get_last_message_id(chat_id, schedule_date_time):
-    meta_file_path = os.path.join(config.out_dir, 'telegram-meta-v2.json')
+def _get_last_message(chat_id, schedule_date_time):
+    meta_file_path = os.path.join(config.out_dir, shard_file_name(MESSAGE_META_FILE_NAME))
     schedule_date_str = schedule_date_time.strftime("%d.%m.%Y")
     
     if not os.path.exists(meta_file_path):
@@ -47,7 +71,15 @@ def _get_last_message_id(chat_id, schedule_date_time):
     with open(meta_file_path, 'r') as f:
         meta_data = json.load(f)
     
-    return meta_data.get(str(chat_id), {}).get(schedule_date_str, None)
+    entry = meta_data.get(str(chat_id), {}).get(schedule_date_str, None)
+    if isinstance(entry, str):
+        # Entries written before message fingerprints were tracked hold the bare message ID
+        entry = {"message_id": entry}
+    return entry
+
+def _get_last_message_id(chat_id, schedule_date_time):
+    entry = _get_last_message(chat_id, schedule_date_time)
+    return entry["message_id"] if entry else None
 
 def remove_old_message(chat_id, schedule_date_time):
     bot = Bot(token=BOT_TOKEN)
@@ -59,38 +91,156 @@ def remove_old_message(chat_id, schedule_date_time):
             except Exception as e:
                 print(f"Failed to delete message {last_message_id} for chat {chat_id}: {e}")
 
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(_delete_msg())
-        loop.close()
+        _run(_delete_msg())
+
+async def _edit_message(bot, chat_id, last_message, message_text, image_bytes, image_md5, caption_md5):
+    """
+    Try to update a previously sent message in place.
+
+    Returns:
+        bool: True if the message now shows the new content, False if it can't be edited
+    """
+    message_id = int(last_message["message_id"])
+    last_kind = last_message.get("kind")
+    try:
+        if image_bytes is None:
+            if last_kind == 'photo':
+                # A photo message can't be turned into a text one
+                return False
+            if last_message.get("caption_md5") != caption_md5:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=message_text, parse_mode='MarkdownV2')
+        elif last_kind == 'photo' and last_message.get("image_md5") == image_md5:
+            if last_message.get("caption_md5") != caption_md5:
+                await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=message_text, parse_mode='MarkdownV2')
+        else:
+            media = InputMediaPhoto(media=image_bytes, caption=message_text, parse_mode='MarkdownV2')
+            await bot.edit_message_media(media=media, chat_id=chat_id, message_id=message_id)
+    except BadRequest as e:
+        if "message is not modified" in str(e).lower():
+            return True
+        print(f"Failed to edit message {message_id} for chat {chat_id}: {e}")
+        return False
+    return True
+
+def _read_image(image_path):
+    """
+    Args:
+        image_path: Path to the image, or the encoded image itself
+
+    Returns:
+        tuple: (image bytes, md5), (None, None) if image_path doesn't exist or is not an image
+    """
+    if isinstance(image_path, bytes):
+        return image_path, _md5(image_path)
+    # Check if image exists and is actually an image file
+    if not image_path or not os.path.isfile(image_path) or image_path.endswith('.json'):
+        return None, None
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+    return image_bytes, _md5(image_bytes)
+
+def _is_quiet_hours():
+    # Check if it's quiet hours in Kyiv (22:00 - 08:00)
+    kyiv_time = datetime.now(KYIV_TZ)
+    return kyiv_time.hour >= 22 or kyiv_time.hour < 8
 
 def post_message_with_image(chat_id, image_path, message_text, schedule_date_time):
-    """Send a message with an image. If image_path doesn't exist or is not an image, sends text only."""
+    """
+    Send a message with an image. If image_path doesn't exist or is not an image, sends text only.
+    image_path can also be the encoded image.
+
+    If a message for the same chat and date was sent before, it is edited in place: only the caption
+    is updated when the image is unchanged. Delete and resend is used only when editing isn't possible.
+    """
     bot = Bot(token=BOT_TOKEN)
-    
-    # Check if image exists and is actually an image file
-    send_with_image = (
-        image_path and 
-        os.path.exists(image_path) and 
-        os.path.isfile(image_path) and
-        not image_path.endswith('.json')
-    )
-
-    remove_old_message(chat_id, schedule_date_time)
+
+    image_bytes, image_md5 = _read_image(image_path)
+    send_with_image = image_bytes is not None
+    caption_md5 = _md5(message_text)
+    kind = 'photo' if send_with_image else 'text'
+
+    last_message = _get_last_message(chat_id, schedule_date_time)
+    if last_message:
+        edited = _run(_edit_message(bot, chat_id, last_message, message_text, image_bytes, image_md5, caption_md5))
+        if edited:
+            _save_message_metadata(chat_id, schedule_date_time, last_message["message_id"], kind, image_md5, caption_md5)
+            return
+        remove_old_message(chat_id, schedule_date_time)
     
     async def _send_msg():
-        # Check if it's quiet hours in Kyiv (22:00 - 08:00)
-        kyiv_time = datetime.now(KYIV_TZ)
-        is_quiet_hours = kyiv_time.hour >= 22 or kyiv_time.hour < 8
-        
+        is_quiet_hours = _is_quiet_hours()
+
         if send_with_image:
-            message = await bot.send_photo(chat_id=chat_id, photo=open(image_path, 'rb'), caption=message_text, parse_mode='MarkdownV2', disable_notification=is_quiet_hours)
+            message = await bot.send_photo(chat_id=chat_id, photo=image_bytes, caption=message_text, parse_mode='MarkdownV2', disable_notification=is_quiet_hours)
         else:
             message = await bot.send_message(chat_id=chat_id, text=message_text, parse_mode='MarkdownV2', disable_notification=is_quiet_hours)
 
-        _save_message_metadata(chat_id, schedule_date_time, message.message_id)
+        _save_message_metadata(chat_id, schedule_date_time, message.message_id, kind, image_md5, caption_md5)
 
-    asyncio.set_event_loop(asyncio.new_event_loop())
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(_send_msg())
-    loop.close()
+    _run(_send_msg())
+
+def post_album(chat_id, items):
+    """
+    Send the schedules of several dates as one album, with one notification.
+
+    Messages sent before for the dates are edited in place when possible, the others are deleted
+    and the dates are sent again together. Dates without an image are sent as separate text messages.
+
+    Args:
+        chat_id: Chat to send to
+        items: List of (image_path or image bytes, message_text, schedule_date_time) tuples, in album order
+    """
+    bot = Bot(token=BOT_TOKEN)
+
+    photos = []
+    for image_path, message_text, schedule_date_time in items:
+        image_bytes, image_md5 = _read_image(image_path)
+        if image_bytes is None:
+            # Albums hold photos only
+            post_message_with_image(chat_id, image_path, message_text, schedule_date_time)
+            continue
+        photos.append((image_bytes, image_md5, message_text, _md5(message_text), schedule_date_time))
+
+    async def _post_album():
+        to_send = []
+        stale_message_ids = []
+        for image_bytes, image_md5, message_text, caption_md5, schedule_date_time in photos:
+            last_message = _get_last_message(chat_id, schedule_date_time)
+            if last_message and await _edit_message(bot, chat_id, last_message, message_text, image_bytes, image_md5, caption_md5):
+                _save_message_metadata(chat_id, schedule_date_time, last_message["message_id"], 'photo', image_md5, caption_md5)
+                continue
+            if last_message:
+                stale_message_ids.append(int(last_message["message_id"]))
+            to_send.append((image_bytes, image_md5, message_text, caption_md5, schedule_date_time))
+
+        if stale_message_ids:
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=stale_message_ids)
+            except Exception as e:
+                print(f"Failed to delete messages {stale_message_ids} for chat {chat_id}: {e}")
+
+        if len(to_send) == 1:
+            image_bytes, image_md5, message_text, caption_md5, schedule_date_time = to_send[0]
+            messages = [await bot.send_photo(chat_id=chat_id, photo=image_bytes, caption=message_text, parse_mode='MarkdownV2',
+                                             disable_notification=_is_quiet_hours())]
+        elif to_send:
+            media = [InputMediaPhoto(media=image_bytes, caption=message_text, parse_mode='MarkdownV2')
+                     for image_bytes, _, message_text, _, _ in to_send]
+            messages = await bot.send_media_group(chat_id=chat_id, media=media, disable_notification=_is_quiet_hours())
+        else:
+            messages = []
+
+        # Each photo of an album is a message of its own, edited and deleted separately later
+        for message, (_, image_md5, _, caption_md5, schedule_date_time) in zip(messages, to_send):
+            _save_message_metadata(chat_id, schedule_date_time, message.message_id, 'photo', image_md5, caption_md5)
+
+    _run(_post_album())
+
+def send_text_message(chat_id, message_text):
+    """Send a standalone MarkdownV2 text message, not tracked in the message metadata."""
+    bot = Bot(token=BOT_TOKEN)
+
+    async def _send_msg():
+        return await bot.send_message(chat_id=chat_id, text=message_text, parse_mode='MarkdownV2')
+
+    return _run(_send_msg())